@@ -0,0 +1,356 @@
+# =====================================================
+# SPACE420OFFICIAL BOT — benchmark offline
+# =====================================================
+# Esegue gli handler di bot.py contro un Bot Telegram finto (nessuna rete):
+#   python bench.py                                  # tutti gli scenari, 1k/100k/1M utenti
+#   python bench.py --sizes 1000,100000 --ops start,buttons --out run.json
+#   python bench.py --compare base.json --out run.json
+# Ogni (scenario, dimensione) gira in un sottoprocesso: RSS di picco misurato in isolamento.
+# Latenza API finta, errori e RetryAfter configurabili da riga di comando.
+# =====================================================
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import sqlite3
+import argparse
+import resource
+import platform
+import itertools
+import subprocess
+import asyncio as aio
+from pathlib import Path
+
+from telegram import Bot, Update
+from telegram.request import BaseRequest
+
+OPS = ["start", "buttons", "broadcast", "export_csv", "export_json", "export_xlsx", "backup", "list"]
+ADMIN = 1
+
+# ---------- BOT FINTO ----------
+class FakeRequest(BaseRequest):
+    """Trasporto HTTP finto per telegram.Bot: risposte sintetiche per metodo.
+
+    latency/jitter in secondi; error_rate = quota di 403 (utente che ha bloccato il bot)
+    sui sendMessage; retry_after_rate = quota di 429 con retry_after secondi.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, retry_after_rate=0.0, retry_after=1, seed=1):
+        self.latency, self.jitter = latency, jitter
+        self.error_rate, self.retry_after_rate, self.retry_after = error_rate, retry_after_rate, retry_after
+        self.calls = {}
+        self._mid = itertools.count(1000)
+        self._rnd = random.Random(seed)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    @staticmethod
+    def _error(code: int, description: str, **params):
+        body = {"ok": False, "error_code": code, "description": description}
+        if params:
+            body["parameters"] = params
+        return code, json.dumps(body).encode()
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api = url.rsplit("/", 1)[-1]
+        self.calls[api] = self.calls.get(api, 0) + 1
+        if self.latency or self.jitter:
+            await aio.sleep(self.latency + self._rnd.random() * self.jitter)
+        params = request_data.parameters if request_data else {}
+        if api == "sendMessage":
+            r = self._rnd.random()
+            if r < self.retry_after_rate:
+                return self._error(429, f"Too Many Requests: retry after {self.retry_after}",
+                                   retry_after=self.retry_after)
+            if r < self.retry_after_rate + self.error_rate:
+                return self._error(403, "Forbidden: bot was blocked by the user")
+        return 200, json.dumps({"ok": True, "result": self._result(api, params)}).encode()
+
+    def _result(self, api: str, params: dict):
+        if api == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        chat_id = params.get("chat_id", ADMIN)
+        msg = {"message_id": next(self._mid), "date": int(time.time()),
+               "chat": {"id": int(chat_id), "type": "private"}}
+        if api == "sendPhoto":
+            msg["photo"] = [{"file_id": "BENCH_PHOTO", "file_unique_id": "bp", "width": 1, "height": 1}]
+        elif api == "sendDocument":
+            msg["document"] = {"file_id": "BENCH_DOC", "file_unique_id": "bd"}
+        elif api.startswith("send") or api.startswith("edit"):
+            msg["text"] = str(params.get("text") or "")
+        else:
+            return True
+        return msg
+
+def make_fake_bot(**opts) -> Bot:
+    return Bot("1:bench", request=FakeRequest(**opts), get_updates_request=FakeRequest())
+
+# ---------- DB SINTETICO ----------
+def make_users_db(path: Path, n: int):
+    """Tabella users con lo schema originale (bot.init_db applica le migrazioni)."""
+    if path.exists():
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.unlink(missing_ok=True)
+    conn = sqlite3.connect(tmp)
+    conn.execute("""CREATE TABLE users(user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT,
+                    last_name TEXT, joined_utc TEXT)""")
+    rnd = random.Random(n)
+    t0 = 1_600_000_000
+    rows = ((i, f"user{i}" if rnd.random() < 0.7 else "", f"Nome{i % 977}", "",
+             time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(t0 + i * 30)))
+            for i in range(1, n + 1))
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+    os.replace(tmp, path)
+
+# ---------- UPDATE SINTETICI ----------
+_uid = itertools.count(1)
+
+def msg_update(bot: Bot, uid: int, text: str) -> Update:
+    ent = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else []
+    return Update.de_json({"update_id": next(_uid), "message": {
+        "message_id": next(_uid), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": f"Nome{uid}", "username": f"user{uid}"},
+        "text": text, "entities": ent}}, bot)
+
+def cb_update(bot: Bot, uid: int, data: str, on_text: bool, message_id: int) -> Update:
+    msg = {"message_id": message_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"}}
+    if on_text:
+        msg["text"] = "panel"
+    else:
+        msg["photo"] = [{"file_id": "BENCH_PHOTO", "file_unique_id": "bp", "width": 1, "height": 1}]
+    return Update.de_json({"update_id": next(_uid), "callback_query": {
+        "id": str(next(_uid)), "chat_instance": "bench", "data": data, "message": msg,
+        "from": {"id": uid, "is_bot": False, "first_name": f"Nome{uid}"}}}, bot)
+
+# ---------- WORKER (un sottoprocesso per scenario) ----------
+def _pct(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+def _rss_mb() -> float:
+    kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return kb / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+async def _dispatch(app, update, lat: list):
+    """Come il fetcher di PTB: passa dall'update processor (sequenziale o concorrente)."""
+    t0 = time.perf_counter()
+    await app.update_processor.process_update(update, app.process_update(update))
+    lat.append(time.perf_counter() - t0)
+
+async def _wait_broadcasts(bot_mod, timeout: float):
+    deadline = time.monotonic() + timeout
+    await aio.sleep(0.05)
+    while time.monotonic() < deadline:
+        running = await bot_mod.db_call(lambda c: c.execute(
+            "SELECT COUNT(*) FROM broadcast_jobs WHERE status='running'").fetchone()[0])
+        if not running:
+            return
+        await aio.sleep(0.05)
+    raise TimeoutError("broadcast non terminato")
+
+async def run_op(bot_mod, app, op: str, size: int, args) -> dict:
+    tg = app.bot
+    rnd = random.Random(42)
+    lat = []
+    if op == "start":
+        # raffica: 90% utenti già registrati, 10% nuovi; metà /start, metà testo libero
+        ups = []
+        for i in range(args.n):
+            uid = rnd.randint(1, size) if rnd.random() < 0.9 else size + 1 + i
+            ups.append(msg_update(tg, uid, "/start" if i % 2 else "ciao"))
+        await aio.gather(*(_dispatch(app, u, lat) for u in ups))
+    elif op == "buttons":
+        seq = [("open_menu", False), ("pg:menu:1", True), ("pg:menu:2", True), ("pg:menu:1", True), ("home", True)]
+        for i in range(max(args.n // len(seq), 1)):
+            uid = rnd.randint(1, size)
+            for data, on_text in seq:
+                await _dispatch(app, cb_update(tg, uid, data, on_text, 500 + i), lat)
+    elif op == "broadcast":
+        await _dispatch(app, msg_update(tg, ADMIN, "/broadcast Messaggio di prova del benchmark"), lat)
+        t0 = time.perf_counter()
+        await _wait_broadcasts(bot_mod, args.timeout)
+        lat = [time.perf_counter() - t0]
+    elif op.startswith("export_"):
+        cmd = {"export_csv": "/export", "export_json": "/export_json", "export_xlsx": "/export_xlsx"}[op]
+        for _ in range(args.repeat):
+            await _dispatch(app, msg_update(tg, ADMIN, cmd), lat)
+    elif op == "backup":
+        for _ in range(args.repeat):
+            await _dispatch(app, msg_update(tg, ADMIN, "/backup_db"), lat)
+    elif op == "list":
+        for _ in range(max(args.n // 10, 1)):
+            await _dispatch(app, msg_update(tg, ADMIN, "/list"), lat)
+    return {"lat": lat}
+
+async def worker_main(args, op: str, size: int, db_path: Path) -> dict:
+    import bot as bot_mod   # importato qui: le variabili d'ambiente sono già impostate
+    bot_mod.init_db()
+    if op == "broadcast":
+        # il broadcast gira su un sottoinsieme fisso: misura il motore, non la dimensione del DB
+        bot_mod.db_run(lambda c: (c.execute("UPDATE users SET active=0 WHERE user_id > ?",
+                                            (args.broadcast_users,)), c.commit()))
+    tg = make_fake_bot(latency=args.latency / 1000, jitter=args.jitter / 1000, error_rate=args.error_rate,
+                       retry_after_rate=args.retry_after_rate, retry_after=args.retry_after)
+    app = bot_mod.build_app(tg)
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    await bot_mod.LEASE.acquire(aio.Event())   # istanza unica: è lei il leader (broadcast, job)
+    fake = tg.request   # stesso FakeRequest per tutte le chiamate non getUpdates
+    calls_before = dict(fake.calls)
+    rss_before = _rss_mb()
+    t0 = time.perf_counter()
+    res = await run_op(bot_mod, app, op, size, args)
+    elapsed = time.perf_counter() - t0
+    calls = {k: v - calls_before.get(k, 0) for k, v in fake.calls.items() if v - calls_before.get(k, 0)}
+    await bot_mod.LEASE.release()
+    await app.stop()
+    if app.post_stop:
+        await app.post_stop(app)
+    await app.shutdown()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+    lat = sorted(res["lat"])
+    units = args.broadcast_users if op == "broadcast" else len(lat)
+    return {
+        "op": op, "size": size, "ops": units, "seconds": round(elapsed, 4),
+        "throughput": round(units / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(_pct(lat, 0.50) * 1000, 3), "p99_ms": round(_pct(lat, 0.99) * 1000, 3),
+        "rss_before_mb": round(rss_before, 1), "peak_rss_mb": round(_rss_mb(), 1),
+        "api_calls": sum(calls.values()), "api_calls_per_op": round(sum(calls.values()) / max(units, 1), 3),
+        "api_calls_by_method": calls,
+    }
+
+def run_worker(args):
+    op, size = args.worker, args.size
+    work = Path(args.workdir) / f"run_{op}_{size}_{os.getpid()}"
+    shutil.rmtree(work, ignore_errors=True)
+    work.mkdir(parents=True)
+    db_path = work / "users.db"
+    shutil.copyfile(Path(args.workdir) / f"users_{size}.db", db_path)
+    os.environ.update({
+        "BOT_TOKEN": "1:bench", "ADMIN_ID": str(ADMIN), "DB_FILE": str(db_path),
+        "BACKUP_DIR": str(work / "backup"), "MENU_TEXT": MENU_SAMPLE,
+        "BROADCAST_RATE": str(args.broadcast_rate), "BROADCAST_EDIT_EVERY": "1",
+    })
+    import logging
+    logging.disable(logging.WARNING)
+    try:
+        result = aio.run(worker_main(args, op, size, db_path))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    print(json.dumps(result))
+
+MENU_SAMPLE = "\n\n".join(
+    f"🌿 Prodotto {i} — " + " ".join(f"descrizione{j}" for j in range(60)) for i in range(20))
+
+# ---------- ORCHESTRAZIONE ----------
+def compare(old: dict, new: dict):
+    key = lambda r: (r["op"], r["size"])
+    base = {key(r): r for r in old["results"]}
+    print(f"{'op':<12}{'size':>9}  {'throughput':>22}  {'p99 ms':>22}  {'peak RSS MB':>20}  {'API/op':>14}")
+    for r in new["results"]:
+        o = base.get(key(r))
+        def cell(field, fmt="{:.1f}"):
+            if not o:
+                return fmt.format(r[field])
+            d = (r[field] - o[field]) / o[field] * 100 if o[field] else 0.0
+            return f"{fmt.format(o[field])}→{fmt.format(r[field])} ({d:+.0f}%)"
+        print(f"{r['op']:<12}{r['size']:>9}  {cell('throughput'):>22}  {cell('p99_ms'):>22}  "
+              f"{cell('peak_rss_mb'):>20}  {cell('api_calls_per_op', '{:.2f}'):>14}")
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark offline di bot.py")
+    ap.add_argument("--sizes", default="1000,100000,1000000")
+    ap.add_argument("--ops", default=",".join(OPS))
+    ap.add_argument("--n", type=int, default=2000, help="update per gli scenari start/buttons/list")
+    ap.add_argument("--repeat", type=int, default=2, help="ripetizioni per export/backup")
+    ap.add_argument("--latency", type=float, default=20.0, help="latenza API finta (ms)")
+    ap.add_argument("--jitter", type=float, default=10.0, help="jitter API finto (ms)")
+    ap.add_argument("--error-rate", type=float, default=0.02, help="quota di 403 sui sendMessage")
+    ap.add_argument("--retry-after-rate", type=float, default=0.001, help="quota di 429 sui sendMessage")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--broadcast-users", type=int, default=5000)
+    ap.add_argument("--broadcast-rate", type=float, default=1000.0, help="BROADCAST_RATE nel bench")
+    ap.add_argument("--timeout", type=float, default=600.0)
+    ap.add_argument("--workdir", default=os.path.join(os.environ.get("TMPDIR", "/tmp"), "space420_bench"))
+    ap.add_argument("--out", default="")
+    ap.add_argument("--compare", default="")
+    ap.add_argument("--worker", default="", help=argparse.SUPPRESS)
+    ap.add_argument("--size", type=int, default=0, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    if args.worker:
+        run_worker(args)
+        return
+
+    sizes = [int(x) for x in args.sizes.split(",") if x]
+    ops = [o for o in args.ops.split(",") if o]
+    unknown = set(ops) - set(OPS)
+    if unknown:
+        ap.error(f"scenari sconosciuti: {', '.join(sorted(unknown))}")
+    for size in sizes:
+        t0 = time.perf_counter()
+        make_users_db(Path(args.workdir) / f"users_{size}.db", size)
+        print(f"# DB {size} utenti pronto ({time.perf_counter() - t0:.1f}s)", file=sys.stderr)
+
+    results = []
+    for size in sizes:
+        for op in ops:
+            cmd = [sys.executable, __file__, *_strip_args(sys.argv[1:]), "--worker", op, "--size", str(size)]
+            p = subprocess.run(cmd, capture_output=True, text=True)
+            if p.returncode != 0:
+                print(f"# {op}@{size} FALLITO:\n{p.stderr[-2000:]}", file=sys.stderr)
+                continue
+            r = json.loads(p.stdout.strip().splitlines()[-1])
+            results.append(r)
+            print(f"{op:<12}{size:>9}  {r['throughput']:>10.1f}/s  p50 {r['p50_ms']:>9.2f}ms  "
+                  f"p99 {r['p99_ms']:>9.2f}ms  RSS {r['peak_rss_mb']:>7.1f}MB  API/op {r['api_calls_per_op']:.2f}")
+    out = {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "argv": sys.argv[1:],
+                    "git": _git_rev()},
+           "results": results}
+    if args.out:
+        Path(args.out).write_text(json.dumps(out, indent=1))
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), out)
+
+def _strip_args(argv):
+    """Argomenti da inoltrare al worker (senza --out/--compare/--sizes/--ops e relativi valori)."""
+    skip = {"--out", "--compare", "--sizes", "--ops"}
+    out, it = [], iter(argv)
+    for a in it:
+        name = a.split("=", 1)[0]
+        if name in skip:
+            if "=" not in a:
+                next(it, None)
+            continue
+        out.append(a)
+    return out
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent).stdout.strip()
+    except OSError:
+        return ""
+
+if __name__ == "__main__":
+    main()
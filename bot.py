@@ -3,34 +3,59 @@
 # =====================================================
 # ✅ Benvenuto con immagine + pulsanti (Menù / Contatti)
 # ✅ Testi lunghissimi (10.000+ caratteri) da variabili ENV
-# ✅ "⬅️ Torna indietro" pulisce i messaggi
-# ✅ Salvataggio utenti (SQLite)
-# ✅ Admin-only in chat privata: status, backup, export (CSV/JSON/XLSX), list, broadcast
-# ✅ Auto-backup giornaliero (UTC) + retention (pulizia backup vecchi)
-# ✅ Anti-conflict (delete_webhook + polling retry)
+# ✅ Menù/Contatti paginati in un solo messaggio (◀️/▶️ e "⬅️ Torna indietro" modificano in place; blocco aperto salvato su SQLite)
+# ✅ Salvataggio utenti (SQLite, WAL, connessione unica su thread dedicato)
+# ✅ Admin-only in chat privata: status, backup, export (CSV/JSON/XLSX), list/find (paginati), stats, broadcast
+# ✅ Broadcast in background: token-bucket, invii paralleli, RetryAfter, ripresa dopo riavvio
+# ✅ Auto-backup giornaliero (UTC) compresso e deduplicato + retention (età/numero/spazio) via manifest
+# ✅ Anti-conflict: lease su SQLite tra istanze (solo il leader fa polling e job, failover ~1s) oppure MODE=webhook
 # ✅ Anti-share: protect_content=True su tutti gli invii del bot
-# ✅ Blocca media degli utenti (foto/video/file) se non admin
+# ✅ Blocca media degli utenti (foto/video/file) se non admin: cancellazioni a blocchi + mute anti-flood
 # ✅ /restore_db: ripristino DB rispondendo a un file .db
+# ✅ Update elaborati in parallelo: ordine garantito per chat, corsia separata per i comandi admin pesanti
+# ✅ Pool HTTP separati: risposte interattive, getUpdates e corsia bulk (broadcast/file) configurabili da ENV
 # =====================================================
 
 import os
 import csv
 import json
-import glob
 import sqlite3
 import logging
 import asyncio as aio
-from time import sleep
+from time import monotonic, perf_counter
+_BOOT_T0 = perf_counter()   # riferimento per i tempi di avvio (STARTUP_TIMING)
+from functools import wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import defaultdict, OrderedDict, deque
+from http import HTTPStatus
 from datetime import datetime, timezone, time as dtime, timedelta
 from pathlib import Path
+from math import log
 from io import BytesIO
+import io
+import hmac
+import signal
+import secrets
+import socket
+import sys
+import zlib
+import gzip
+import hashlib
+import threading
 import shutil
+import tempfile
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 
 from telegram import (
+    Bot,
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     InputFile,
+    ChatPermissions,
 )
 from telegram.ext import (
     ApplicationBuilder,
@@ -39,10 +64,12 @@ from telegram.ext import (
     CallbackQueryHandler,
     MessageHandler,
     ContextTypes,
+    BaseUpdateProcessor,
     filters,
 )
+import httpx
 import telegram.error as tgerr
-from openpyxl import Workbook
+from telegram.request import HTTPXRequest
 
 # ---------- LOG ----------
 logging.basicConfig(
@@ -53,12 +80,16 @@ logger = logging.getLogger("space420")
 # ---------- ENV ----------
 BOT_TOKEN  = os.environ.get("BOT_TOKEN")
 ADMIN_ID   = int(os.environ.get("ADMIN_ID", "0"))
+# altri admin opzionali: ADMIN_IDS="123,456" (si aggiungono ad ADMIN_ID)
+ADMINS     = frozenset({ADMIN_ID} | {int(x) for x in os.environ.get("ADMIN_IDS", "").replace(" ", "").split(",") if x}) - {0}
 
 DB_FILE    = os.environ.get("DB_FILE", "./data/users.db")
 BACKUP_DIR = os.environ.get("BACKUP_DIR", "./backup")
 
 WELCOME_PHOTO_URL = (os.environ.get("WELCOME_PHOTO_URL") or
     "https://i.postimg.cc/D0JhvYfw/1230-DD1-F-7504-4131-8-F96-FA4398-A29-B39.jpg").strip()
+# opzionale: file locale caricato una sola volta (poi si riusa il file_id)
+WELCOME_PHOTO_FILE = (os.environ.get("WELCOME_PHOTO_FILE") or "").strip()
 WELCOME_TITLE = os.environ.get(
     "WELCOME_TITLE", "BENVENUTI NEL SPACE CLUB 🇺🇸🇪🇸🇲🇦🇮🇹🇳🇱"
 )
@@ -67,6 +98,80 @@ WELCOME_TITLE = os.environ.get(
 BACKUP_TIME           = os.environ.get("BACKUP_TIME", "03:00")  # HH:MM (UTC)
 BACKUP_NOTIFY_ADMIN   = os.environ.get("BACKUP_NOTIFY_ADMIN", "0")  # "1" per notificare
 BACKUP_RETENTION_DAYS = int(os.environ.get("BACKUP_RETENTION_DAYS", "14"))
+BACKUP_MAX_COUNT      = int(os.environ.get("BACKUP_MAX_COUNT", "0"))       # 0 = nessun limite
+BACKUP_MAX_TOTAL_MB   = int(os.environ.get("BACKUP_MAX_TOTAL_MB", "0"))    # 0 = nessun limite
+BACKUP_COMPRESS       = os.environ.get("BACKUP_COMPRESS", "gzip").lower()  # gzip | zstd | none
+BACKUP_PAGES          = int(os.environ.get("BACKUP_PAGES", "1024"))        # pagine copiate per step
+
+# Modalità di servizio: "polling" (default) oppure "webhook" (server HTTP integrato)
+MODE                    = os.environ.get("MODE", "polling").strip().lower()
+WEBHOOK_URL             = (os.environ.get("WEBHOOK_URL") or "").strip()   # URL pubblico base (https://…)
+WEBHOOK_PATH            = "/" + os.environ.get("WEBHOOK_PATH", "telegram").strip("/")
+# stesso valore su tutte le istanze: se non impostato si deriva dal token (mai casuale)
+WEBHOOK_SECRET          = os.environ.get("WEBHOOK_SECRET") or hmac.new(
+    (BOT_TOKEN or "").encode(), b"space420-webhook", hashlib.sha256).hexdigest()
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+HTTP_LISTEN             = os.environ.get("HTTP_LISTEN", "0.0.0.0")
+HTTP_PORT               = int(os.environ.get("PORT", "8080"))
+HTTP_MAX_BODY           = int(os.environ.get("HTTP_MAX_BODY", str(1024 * 1024)))
+HTTP_REQUEST_TIMEOUT    = float(os.environ.get("HTTP_REQUEST_TIMEOUT", "10"))  # header + body di una richiesta (s)
+HTTP_IDLE_TIMEOUT       = float(os.environ.get("HTTP_IDLE_TIMEOUT", "10"))     # keep-alive inattivo prima della chiusura
+HTTP_SPARE_CONNECTIONS  = int(os.environ.get("HTTP_SPARE_CONNECTIONS", "8"))   # posti oltre WEBHOOK_MAX_CONNECTIONS
+
+# Metriche: /perf (admin) e /metrics formato Prometheus (server su METRICS_PORT, o porta pubblica con token)
+METRICS_PORT  = int(os.environ.get("METRICS_PORT", "0"))   # 0 = nessun server /metrics separato
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")       # se impostato /metrics vuole "Bearer <token>";
+                                                          # in webhook serve per averla sulla porta pubblica
+STARTUP_TIMING = os.environ.get("STARTUP_TIMING", "0") == "1"   # log dei tempi di avvio per fase
+
+# Update in parallelo tra chat diverse (in ordine dentro la stessa chat)
+UPDATE_CONCURRENCY     = int(os.environ.get("UPDATE_CONCURRENCY", "32"))    # handler utente insieme
+ADMIN_LANE_CONCURRENCY = int(os.environ.get("ADMIN_LANE_CONCURRENCY", "2")) # comandi admin pesanti
+
+# Write-behind: registrazioni/profili scritti a blocchi da un solo writer
+WB_FLUSH_MS  = int(os.environ.get("WB_FLUSH_MS", "200"))   # flush almeno ogni N ms
+WB_MAX_BATCH = int(os.environ.get("WB_MAX_BATCH", "500"))  # … o appena ci sono M record
+
+# Moderazione media: cancellazioni raccolte per chat + mute temporaneo nei gruppi
+MOD_FLUSH_MS   = int(os.environ.get("MOD_FLUSH_MS", "700"))     # attesa prima di deleteMessages
+MOD_WINDOW_S   = int(os.environ.get("MOD_WINDOW_S", "30"))      # finestra scorrevole per utente
+MOD_MAX_MEDIA  = int(os.environ.get("MOD_MAX_MEDIA", "10"))     # media in finestra prima del mute
+MOD_MUTE_S     = int(os.environ.get("MOD_MUTE_S", "600"))       # primo mute; raddoppia a ogni recidiva
+MOD_MUTE_MAX_S = int(os.environ.get("MOD_MUTE_MAX_S", "86400"))
+
+# Più istanze (es. durante un redeploy): solo chi ha la lease fa polling e job pianificati
+LEADER_DB       = os.environ.get("LEADER_DB") or str(Path(DB_FILE).with_name("leader.db"))
+LEASE_TTL       = float(os.environ.get("LEASE_TTL", "1.0"))        # s di validità di ogni rinnovo
+LEASE_HEARTBEAT = float(os.environ.get("LEASE_HEARTBEAT", "0.25")) # s tra rinnovi / tentativi standby
+
+# Stato UI per utente (blocco aperto): LRU in memoria + tabella ui_state
+UI_STATE_MAX      = int(os.environ.get("UI_STATE_MAX", "20000"))     # utenti tenuti in RAM
+UI_SWEEP_MINUTES  = int(os.environ.get("UI_SWEEP_MINUTES", "60"))    # giro dello sweeper
+
+# Export: letti a blocchi e scritti su file temporaneo (memoria costante)
+EXPORT_BATCH     = int(os.environ.get("EXPORT_BATCH", "2000"))
+EXPORT_SPOOL_MB  = int(os.environ.get("EXPORT_SPOOL_MB", "8"))    # oltre, il temp file va su disco
+EXPORT_SAVE_COPY = os.environ.get("EXPORT_SAVE_COPY", "0")        # "1" = copia anche in BACKUP_DIR
+
+# Broadcast: limiti Telegram ~30 msg/s globali e ~1 msg/s per chat
+BROADCAST_RATE        = float(os.environ.get("BROADCAST_RATE", "25"))       # msg/s globali
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "8"))   # invii in parallelo
+BROADCAST_BATCH       = int(os.environ.get("BROADCAST_BATCH", "500"))       # utenti per checkpoint
+BROADCAST_MAX_RETRIES = int(os.environ.get("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_EDIT_EVERY  = float(os.environ.get("BROADCAST_EDIT_EVERY", "3"))  # s tra aggiornamenti stato
+
+# Pool HTTP verso la Bot API, uno per corsia: "interactive" (menu e risposte), "updates"
+# (getUpdates) e "bulk" (broadcast, upload/download di backup, export e restore)
+HTTP_POOL_SIZE         = int(os.environ.get("HTTP_POOL_SIZE", "64"))        # richieste insieme, corsia interattiva
+HTTP_BULK_POOL_SIZE    = int(os.environ.get("HTTP_BULK_POOL_SIZE", str(BROADCAST_CONCURRENCY + 4)))
+HTTP_POOL_TIMEOUT      = float(os.environ.get("HTTP_POOL_TIMEOUT", "3"))    # attesa max di un posto libero (s)
+HTTP_BULK_POOL_TIMEOUT = float(os.environ.get("HTTP_BULK_POOL_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT   = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT      = float(os.environ.get("HTTP_READ_TIMEOUT", "10"))
+HTTP_WRITE_TIMEOUT     = float(os.environ.get("HTTP_WRITE_TIMEOUT", "10"))
+HTTP_BULK_TIMEOUT      = float(os.environ.get("HTTP_BULK_TIMEOUT", "300"))  # lettura/scrittura file, corsia bulk
+HTTP_KEEPALIVE_S       = float(os.environ.get("HTTP_KEEPALIVE_S", "30"))    # connessioni inattive tenute aperte
+HTTP2                  = os.environ.get("HTTP2", "0") == "1"   # serve python-telegram-bot[http2], altrimenti HTTP/1.1
 
 # ---------- MENU / CONTATTI ----------
 DEFAULT_MENU = "#MENU (default)\nImposta la variabile d'ambiente MENU_TEXT su Render."
@@ -79,11 +184,9 @@ BTN_MENU     = os.environ.get("BTN_MENU", "📖 Menù")
 BTN_CONTACTS = os.environ.get("BTN_CONTACTS", "📲 Contatti")
 BTN_BACK     = os.environ.get("BTN_BACK", "⬅️ Torna indietro")
 
-OPEN_KEY = "open_msgs_ids"  # per ricordare messaggi aperti
-
 # ---------- UTILITIES ----------
 def is_admin(uid: int) -> bool:
-    return uid != 0 and uid == ADMIN_ID
+    return uid in ADMINS
 
 def is_private(update: Update) -> bool:
     chat = update.effective_chat
@@ -93,11 +196,311 @@ def admin_only_private(update: Update) -> bool:
     user = update.effective_user
     return bool(user and is_admin(user.id) and is_private(update))
 
+# ---------- AVVIO (tempi per fase) ----------
+# Ogni fase registra (inizio, fine) in secondi da _BOOT_T0; solo la prima occorrenza conta
+# (es. "lease" dopo un failover non sovrascrive quella dell'avvio).
+STARTUP_PHASES = {}
+_first_update_pending = True
+
+def _mark(name: str, t_start: float):
+    STARTUP_PHASES.setdefault(name, (t_start - _BOOT_T0, perf_counter() - _BOOT_T0))
+
+async def _timed(name: str, aw):
+    t0 = perf_counter()
+    try:
+        return await aw
+    finally:
+        _mark(name, t0)
+
+def startup_report() -> str:
+    lines = ["Tempi di avvio (s dall'avvio del processo):"]
+    for name, (a, b) in sorted(STARTUP_PHASES.items(), key=lambda kv: kv[1]):
+        lines.append(f"  {name:<14} {a:7.3f} → {b:7.3f}  ({(b - a) * 1000:6.0f} ms)")
+    return "\n".join(lines)
+
+def _note_first_update(t_start: float):
+    global _first_update_pending
+    _first_update_pending = False
+    _mark("first_update", t_start)
+    logger.info(f"Primo update gestito a {STARTUP_PHASES['first_update'][1]:.3f}s dall'avvio")
+    if STARTUP_TIMING:
+        logger.info(startup_report())
+
+# ---------- METRICHE ----------
+class Histogram:
+    """Istogramma a bucket fissi (secondi): observe() costa un bisect e tre somme."""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    __slots__ = ("counts", "total", "n", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.n = 0
+        self.max = 0.0
+
+    def observe(self, v: float):
+        self.counts[bisect_left(self.BUCKETS, v)] += 1
+        self.total += v
+        self.n += 1
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q: float) -> float:
+        """Stima per interpolazione lineare dentro il bucket."""
+        if not self.n:
+            return 0.0
+        rank, seen, lo = q * self.n, 0, 0.0
+        for i, c in enumerate(self.counts):
+            hi = self.BUCKETS[i] if i < len(self.BUCKETS) else self.max
+            if c and seen + c >= rank:
+                return min(lo + (hi - lo) * (rank - seen) / c, self.max)
+            seen += c
+            lo = hi
+        return self.max
+
+class Metrics:
+    HIST_LABELS = {"handler": "handler", "api": "method", "db": "op", "loop_lag": "loop", "write_behind": "stage",
+                   "lane_wait": "lane", "http_pool_wait": "lane"}
+    COUNTER_LABELS = {
+        "handler_errors": ("handler", "exception"),
+        "handler_api_calls": ("handler",),
+        "api_calls": ("method", "status"),
+        "api_errors": ("method", "exception"),
+        "mod_errors": ("action", "exception"),
+        "http_pool_saturated": ("lane",),
+        "http_pool_timeouts": ("lane",),
+    }
+
+    def __init__(self):
+        self.started = monotonic()
+        self.hists = defaultdict(Histogram)   # (nome, etichetta) -> Histogram
+        self.counters = defaultdict(int)      # (nome, etichette...) -> int
+        self.gauges = {}                      # nome -> callable() -> numero
+
+    def observe(self, name: str, label: str, v: float):
+        self.hists[(name, label)].observe(v)
+
+    def inc(self, key: tuple, n: int = 1):
+        self.counters[key] += n
+
+    def render_prometheus(self) -> str:
+        out = []
+        for (name, label), h in sorted(self.hists.items()):
+            lk = self.HIST_LABELS.get(name, "label")
+            base = f'space420_{name}_seconds'
+            cum = 0
+            for b, c in zip(Histogram.BUCKETS + (float("inf"),), h.counts):
+                cum += c
+                le = "+Inf" if b == float("inf") else f"{b:g}"
+                out.append(f'{base}_bucket{{{lk}="{label}",le="{le}"}} {cum}')
+            out.append(f'{base}_sum{{{lk}="{label}"}} {h.total:.6f}')
+            out.append(f'{base}_count{{{lk}="{label}"}} {h.n}')
+        for key, v in sorted(self.counters.items()):
+            name, *vals = key
+            keys = self.COUNTER_LABELS.get(name) or [f"label{i}" for i in range(len(vals))]
+            lbl = ",".join(f'{k}="{x}"' for k, x in zip(keys, vals))
+            out.append(f"space420_{name}_total{{{lbl}}} {v}")
+        for name, fn in sorted(self.gauges.items()):
+            try: out.append(f"space420_{name} {float(fn())}")
+            except Exception: pass
+        out.append(f"space420_uptime_seconds {monotonic() - self.started:.0f}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+_api_calls = ContextVar("space420_api_calls", default=None)   # contatore chiamate API dell'handler corrente
+
+def instrument(fn):
+    """Avvolge un handler: latenza, errori per tipo e chiamate API effettuate."""
+    name = fn.__name__
+
+    @wraps(fn)
+    async def wrapper(update, context):
+        counter = [0]
+        token = _api_calls.set(counter)
+        t0 = perf_counter()
+        try:
+            return await fn(update, context)
+        except Exception as e:
+            METRICS.inc(("handler_errors", name, type(e).__name__))
+            raise
+        finally:
+            METRICS.observe("handler", name, perf_counter() - t0)
+            METRICS.inc(("handler_api_calls", name), counter[0])
+            _api_calls.reset(token)
+            if _first_update_pending:
+                _note_first_update(t0)
+    return wrapper
+
+def instrument_handlers(app: Application):
+    for handlers in app.handlers.values():
+        for h in handlers:
+            h.callback = instrument(h.callback)
+
+def http_version() -> str:
+    if not HTTP2:
+        return "1.1"
+    try:
+        import h2  # noqa: F401  (extra python-telegram-bot[http2])
+    except ImportError:
+        logger.warning("HTTP2=1 ma il pacchetto h2 non è installato: uso HTTP/1.1.")
+        return "1.1"
+    return "2"
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest che conta e cronometra ogni chiamata alla Bot API (per metodo).
+    Ogni istanza è una corsia col proprio pool: i posti sono contati qui, così l'attesa
+    di una connessione libera e la saturazione del pool finiscono nelle metriche."""
+    lanes = {}   # nome corsia -> richiesta (gauge e /perf)
+
+    def __init__(self, lane: str, pool_size: int, pool_timeout: float = HTTP_POOL_TIMEOUT,
+                 keepalive_s: float = HTTP_KEEPALIVE_S, **kwargs):
+        pool_size = max(1, pool_size)
+        super().__init__(connection_pool_size=pool_size, pool_timeout=pool_timeout, **kwargs)
+        # PTB non espone la durata del keep-alive: stessi limiti + keepalive_expiry
+        self._client_kwargs["limits"] = httpx.Limits(max_connections=pool_size,
+                                                     max_keepalive_connections=pool_size,
+                                                     keepalive_expiry=keepalive_s)
+        self._client = self._build_client()
+        self.lane, self.pool_size, self.pool_timeout = lane, pool_size, pool_timeout
+        self.in_flight = 0
+        self._slots = aio.Semaphore(pool_size)
+        InstrumentedRequest.lanes[lane] = self
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api = url.rsplit("/", 1)[-1]
+        counter = _api_calls.get()
+        if counter is not None:
+            counter[0] += 1
+        t0 = perf_counter()
+        if not self._slots.locked():
+            await self._slots.acquire()   # posto libero: nessuna sospensione
+        else:
+            METRICS.inc(("http_pool_saturated", self.lane))
+            try:
+                await aio.wait_for(self._slots.acquire(), self.pool_timeout)
+            except aio.TimeoutError:
+                METRICS.inc(("http_pool_timeouts", self.lane))
+                METRICS.inc(("api_errors", api, "PoolTimeout"))
+                raise tgerr.TimedOut(f"Pool timeout: corsia HTTP {self.lane} piena") from None
+        METRICS.observe("http_pool_wait", self.lane, perf_counter() - t0)
+        self.in_flight += 1
+        t0 = perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+        except Exception as e:
+            METRICS.inc(("api_errors", api, type(e).__name__))
+            raise
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+            METRICS.observe("api", api, perf_counter() - t0)
+        METRICS.inc(("api_calls", api, str(code)))
+        return code, payload
+
+BULK_BOT = None   # Bot con pool separato per broadcast e file (creato in build_app)
+
+def bulk_bot(bot):
+    """Bot della corsia bulk; senza corsia dedicata (bench.py) resta quello dell'app."""
+    return BULK_BOT or bot
+
+async def loop_lag_monitor(interval: float = 0.5):
+    while True:
+        t0 = perf_counter()
+        await aio.sleep(interval)
+        METRICS.observe("loop_lag", "event_loop", max(perf_counter() - t0 - interval, 0.0))
+
 # ---------- DATABASE ----------
-def init_db():
+# Una sola connessione long-lived (WAL) usata da un thread dedicato: tutte le query
+# passano da db_call() e vengono attese senza bloccare l'event loop.
+DB_CACHE_KB = int(os.environ.get("DB_CACHE_KB", "8000"))
+DB_MMAP_MB  = int(os.environ.get("DB_MMAP_MB", "64"))
+USERS_FTS   = os.environ.get("USERS_FTS", "0") == "1"   # ricerca full-text (FTS5) per DB grandi
+
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+_db_conn = None
+
+def _open_db() -> sqlite3.Connection:
     Path(DB_FILE).parent.mkdir(parents=True, exist_ok=True)
-    Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, timeout=10, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")   # sicuro in WAL, niente fsync per ogni commit
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_MB * 1024 * 1024}")
+    conn.execute("PRAGMA busy_timeout=10000")
+    return conn
+
+def _db() -> sqlite3.Connection:
+    """Connessione condivisa: da usare SOLO nel thread del DB (via db_call / db_run)."""
+    global _db_conn
+    if _db_conn is None:
+        _db_conn = _open_db()
+    return _db_conn
+
+def _db_close():
+    global _db_conn
+    if _db_conn is not None:
+        try: _db_conn.close()
+        except Exception as e: logger.warning(f"db close: {e}")
+        _db_conn = None
+
+class FileGate:
+    """Connessioni proprie su DB_FILE (export, backup) contro lo swap di /restore_db:
+    mentre il file viene sostituito nessuna di queste resta aperta."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._swapping = False
+
+    @contextmanager
+    def reading(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._swapping)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    def begin_swap(self, timeout: float) -> bool:
+        """Ferma i nuovi lettori e attende l'uscita degli altri (bloccante: worker thread)."""
+        with self._cond:
+            self._swapping = True
+            if self._cond.wait_for(lambda: self._readers == 0, timeout):
+                return True
+            self._swapping = False
+            self._cond.notify_all()
+            return False
+
+    def end_swap(self):
+        with self._cond:
+            self._swapping = False
+            self._cond.notify_all()
+
+DB_FILE_GATE = FileGate()
+
+def db_run(fn, *args, **kwargs):
+    """Versione sincrona (startup/shutdown): esegue fn(conn, ...) nel thread del DB."""
+    return _db_executor.submit(lambda: fn(_db(), *args, **kwargs)).result()
+
+async def db_call(fn, *args, **kwargs):
+    """Esegue fn(conn, ...) nel thread del DB e ne attende il risultato."""
+    loop = aio.get_running_loop()
+    t0 = perf_counter()
+    try:
+        return await loop.run_in_executor(_db_executor, lambda: fn(_db(), *args, **kwargs))
+    finally:
+        METRICS.observe("db", fn.__name__, perf_counter() - t0)   # attesa in coda inclusa
+
+async def db_close():
+    loop = aio.get_running_loop()
+    await loop.run_in_executor(_db_executor, _db_close)
+
+def _init_schema(conn):
     conn.execute("""CREATE TABLE IF NOT EXISTS users(
         user_id INTEGER PRIMARY KEY,
         username TEXT,
@@ -105,48 +508,921 @@ def init_db():
         last_name TEXT,
         joined_utc TEXT
     )""")
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(users)")}
+    if "active" not in cols:   # DB creati prima del broadcast engine
+        conn.execute("ALTER TABLE users ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+    conn.execute("""CREATE TABLE IF NOT EXISTS broadcast_jobs(
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL,
+        created_utc TEXT,
+        finished_utc TEXT,
+        total INTEGER NOT NULL DEFAULT 0,
+        cursor INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        blocked INTEGER NOT NULL DEFAULT 0,
+        admin_chat_id INTEGER,
+        status_msg_id INTEGER
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS media_cache(
+        source TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        updated_utc TEXT
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS ui_state(
+        user_id INTEGER PRIMARY KEY,
+        chat_id INTEGER NOT NULL,
+        msg_ids TEXT NOT NULL,
+        updated_ts REAL NOT NULL
+    )""")
     conn.commit()
-    conn.close()
+    _migrate(conn)
+    if USERS_FTS:
+        _ensure_fts(conn)
+
+# Migrazioni numerate: PRAGMA user_version = numero dell'ultima applicata.
+# Si aggiungono SOLO in coda, mai modificare quelle già rilasciate.
+def _m1_user_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_joined ON users(joined_utc, user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_first_name ON users(first_name COLLATE NOCASE)")
+
+def _m2_stats(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS stats_daily(
+        day TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        n INTEGER NOT NULL,
+        PRIMARY KEY (day, metric)
+    ) WITHOUT ROWID""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS stats_uniques(
+        day TEXT PRIMARY KEY,
+        hll BLOB NOT NULL
+    )""")
+    # contatore utenti tenuto dai trigger: /utenti non fa più COUNT(*)
+    conn.execute("CREATE TABLE IF NOT EXISTS counters(name TEXT PRIMARY KEY, n INTEGER NOT NULL)")
+    conn.execute("INSERT OR REPLACE INTO counters(name, n) VALUES ('users', (SELECT COUNT(*) FROM users))")
+    conn.execute("""INSERT OR IGNORE INTO stats_daily(day, metric, n)
+        SELECT substr(joined_utc, 1, 10), 'new_users', COUNT(*) FROM users
+        WHERE joined_utc IS NOT NULL GROUP BY 1""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS users_count_ai AFTER INSERT ON users BEGIN
+        UPDATE counters SET n = n + 1 WHERE name = 'users';
+        INSERT INTO stats_daily(day, metric, n) VALUES (date('now'), 'new_users', 1)
+            ON CONFLICT(day, metric) DO UPDATE SET n = n + 1;
+    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS users_count_ad AFTER DELETE ON users BEGIN
+        UPDATE counters SET n = n - 1 WHERE name = 'users';
+    END""")
+
+MIGRATIONS = [_m1_user_indexes, _m2_stats]
+
+def _migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for n, step in enumerate(MIGRATIONS[version:], version + 1):
+        t0 = perf_counter()
+        with conn:
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {n}")
+        logger.info(f"DB migrato alla versione {n} ({step.__name__}, {perf_counter() - t0:.2f}s)")
+
+_fts_ready = False
+
+def _ensure_fts(conn):
+    """Indice FTS5 esterno su username/first_name, tenuto allineato da trigger."""
+    global _fts_ready
+    try:
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name='users_fts'").fetchone()
+        with conn:
+            conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                username, first_name, content='users', content_rowid='user_id', prefix='2 3')""")
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+                INSERT INTO users_fts(rowid, username, first_name) VALUES (new.user_id, new.username, new.first_name);
+            END""")
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+                INSERT INTO users_fts(users_fts, rowid, username, first_name)
+                    VALUES ('delete', old.user_id, old.username, old.first_name);
+            END""")
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username, first_name ON users BEGIN
+                INSERT INTO users_fts(users_fts, rowid, username, first_name)
+                    VALUES ('delete', old.user_id, old.username, old.first_name);
+                INSERT INTO users_fts(rowid, username, first_name) VALUES (new.user_id, new.username, new.first_name);
+            END""")
+            if not exists:
+                conn.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+        _fts_ready = True
+    except sqlite3.OperationalError as e:   # SQLite compilato senza FTS5
+        _fts_ready = False
+        logger.warning(f"FTS5 non disponibile, /find usa gli indici NOCASE: {e}")
+
+def init_db():
+    """Avvio sincrono completo (bench.py, script); il bot usa startup() con le fasi in parallelo."""
+    Path(DB_FILE).parent.mkdir(parents=True, exist_ok=True)
+    Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
+    db_run(_init_schema)
+    USER_INDEX.load(*_read_known_users())
+    logger.info(f"Indice utenti caricato: {len(USER_INDEX)} id")
+    _media_cache.update(db_run(_q_media_all))
+
+def _read_known_users():
+    """Dati per l'indice utenti da una connessione read-only propria (il thread DB resta libero)."""
+    with DB_FILE_GATE.reading():
+        conn = sqlite3.connect(f"file:{Path(DB_FILE).resolve()}?mode=ro", uri=True)
+        try:
+            return _q_known_users(conn)
+        finally:
+            conn.close()
+
+async def warm_user_index():
+    # finché non è pronto add_user_if_new accoda anche utenti già noti: scritture idempotenti
+    USER_INDEX.load(*await aio.to_thread(_read_known_users))
+    logger.info(f"Indice utenti caricato: {len(USER_INDEX)} id")
+
+async def startup(app: Application):
+    """Fasi indipendenti in parallelo: schema DB + cache media, initialize (getMe), post_init.
+    L'indice utenti (lettura più lunga con DB grandi) si carica dopo, in background."""
+    async def db_phase():
+        await _timed("db_schema", db_call(_init_schema))
+        _media_cache.update(await _timed("media_cache", db_call(_q_media_all)))
+
+    phases = [db_phase(), _timed("initialize", app.initialize())]
+    if BULK_BOT:
+        phases.append(_timed("bulk_bot", BULK_BOT.initialize()))
+    await aio.gather(*phases)
+    if app.post_init:
+        await _timed("post_init", app.post_init(app))
+    _spawn(_timed("user_index", warm_user_index()))
+
+SQL_INSERT_USER = """INSERT INTO users(user_id, username, first_name, last_name, joined_utc)
+                     VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO NOTHING"""
+SQL_UPDATE_PROFILE = """UPDATE users SET username=?, first_name=?, last_name=?, active=1
+                        WHERE user_id=? AND (username IS NOT ? OR first_name IS NOT ?
+                                             OR last_name IS NOT ? OR active=0)"""
+
+def _q_apply_batch(conn, groups: dict) -> dict:
+    """Una transazione per tutto il blocco: {sql: [params, ...]} -> {sql: righe modificate}."""
+    changed = {}
+    with conn:
+        for sql, rows in groups.items():
+            changed[sql] = conn.executemany(sql, rows).rowcount
+    return changed
+
+def _q_count_users(conn) -> int:
+    return conn.execute("SELECT n FROM counters WHERE name='users'").fetchone()[0]
+
+USER_COLS = "user_id, username, first_name, joined_utc, active"
+
+def _q_users_page(conn, cursor: int = 0, older: bool = True, limit: int = 25):
+    """Pagina keyset su (joined_utc, user_id), dal più recente. cursor = user_id di confine
+    (0 = prima pagina); older=False torna verso i più recenti. Ritorna (righe, altre_oltre)."""
+    if not cursor:
+        rows = conn.execute(f"SELECT {USER_COLS} FROM users ORDER BY joined_utc DESC, user_id DESC LIMIT ?",
+                            (limit + 1,)).fetchall()
+    else:
+        op, order = ("<", "DESC") if older else (">", "ASC")
+        rows = conn.execute(
+            f"SELECT {USER_COLS} FROM users WHERE (joined_utc, user_id) {op} "
+            f"((SELECT joined_utc FROM users WHERE user_id=?), ?) "
+            f"ORDER BY joined_utc {order}, user_id {order} LIMIT ?", (cursor, cursor, limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not older:
+        rows.reverse()
+    return rows, more
+
+def _like_prefix(prefix: str) -> str:
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def _q_find_users(conn, prefix: str, limit: int = 50):
+    """Utenti il cui username o nome inizia con prefix (senza distinzione maiuscole)."""
+    if _fts_ready:
+        terms = " ".join('"' + t.replace('"', '""') + '"*' for t in prefix.split())
+        return conn.execute(
+            "SELECT u.user_id, u.username, u.first_name, u.joined_utc, u.active FROM users_fts f "
+            "JOIN users u ON u.user_id = f.rowid WHERE users_fts MATCH ? "
+            "ORDER BY u.joined_utc DESC LIMIT ?", (terms, limit)).fetchall()
+    pat = _like_prefix(prefix)
+    return conn.execute(
+        f"SELECT {USER_COLS} FROM users WHERE username LIKE ? ESCAPE '\\' "
+        f"UNION SELECT {USER_COLS} FROM users WHERE first_name LIKE ? ESCAPE '\\' "
+        f"ORDER BY joined_utc DESC LIMIT ?", (pat, pat, limit)).fetchall()
+
+def _q_user_counts(conn) -> dict:
+    users, active = conn.execute("SELECT COUNT(*), COALESCE(SUM(active), 0) FROM users").fetchone()
+    return {"users": users, "active": active}
+
+def _q_swap_db(conn, staging: Path) -> dict:
+    """Sostituisce atomicamente DB_FILE con staging (già validato e migrato).
+
+    Gira nel thread del DB, quindi nessuna query concorrente: i dati restano bloccati
+    solo per checkpoint + rename. Restituisce i conteggi del DB precedente.
+    Le altre istanze terrebbero aperto il file vecchio (e ci scriverebbero senza errori):
+    se il checkpoint è incompleto o il file è aperto altrove lo swap viene annullato.
+    """
+    old = _q_user_counts(conn)
+    busy, log_frames, done = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    if busy or log_frames != done:
+        raise RuntimeError("checkpoint del WAL incompleto: il DB è in uso da un'altra istanza, fermala e riprova")
+    _db_close()
+    probe = sqlite3.connect(DB_FILE, timeout=1)
+    try:
+        # in WAL ogni connessione aperta, anche inattiva, impedisce il lock esclusivo
+        probe.execute("PRAGMA locking_mode=EXCLUSIVE")
+        probe.execute("BEGIN EXCLUSIVE")
+        probe.rollback()
+    except sqlite3.OperationalError:
+        probe.close()
+        _db()
+        raise RuntimeError("il DB è aperto da un'altra istanza: fermala prima di /restore_db")
+    probe.close()
+    for suffix in ("-wal", "-shm"):   # mai lasciare un WAL vecchio accanto al file nuovo
+        Path(DB_FILE + suffix).unlink(missing_ok=True)
+    os.replace(staging, DB_FILE)
+    dir_fd = os.open(Path(DB_FILE).parent, os.O_RDONLY)
+    try: os.fsync(dir_fd)   # il rename sopravvive a un crash
+    finally: os.close(dir_fd)
+    _db()
+    return old
+
+def _profile_fp(username, first_name, last_name) -> int:
+    return zlib.crc32(f"{username or ''}\x1f{first_name or ''}\x1f{last_name or ''}".encode())
+
+def _q_known_users(conn):
+    ids, fps = array("q"), array("I")
+    for uid, un, fn, ln in conn.execute(
+            "SELECT user_id, username, first_name, last_name FROM users WHERE active=1 ORDER BY user_id"):
+        ids.append(uid)
+        fps.append(_profile_fp(un, fn, ln))
+    return ids, fps
+
+# ---------- INDICE UTENTI IN MEMORIA ----------
+class UserIndex:
+    """Utenti registrati (e attivi) -> impronta CRC32 di username/nome/cognome.
+
+    Base = array('q') ordinato di id + array('I') parallelo di impronte (12 byte/utente,
+    ricerca con bisect); i nuovi id finiscono in un piccolo dict fuso nella base ogni
+    MERGE_AT inserimenti. L'impronta permette di accorgersi dei cambi profilo senza DB.
+    """
+
+    MERGE_AT = 16384
+
+    def __init__(self):
+        self._ids = array("q")
+        self._fps = array("I")
+        self._recent = {}
+
+    def load(self, ids: array, fps: array):
+        self._ids, self._fps = ids, fps
+        self._recent = {}
+
+    def _pos(self, uid: int) -> int:
+        i = bisect_left(self._ids, uid)
+        return i if i < len(self._ids) and self._ids[i] == uid else -1
+
+    def get(self, uid: int):
+        fp = self._recent.get(uid)
+        if fp is not None:
+            return fp
+        i = self._pos(uid)
+        return self._fps[i] if i >= 0 else None
+
+    def __contains__(self, uid: int) -> bool:
+        return self.get(uid) is not None
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._recent)
+
+    def set(self, uid: int, fp: int):
+        i = self._pos(uid)
+        if i >= 0:
+            self._fps[i] = fp
+            return
+        self._recent[uid] = fp
+        if len(self._recent) >= self.MERGE_AT:
+            self._merge()
+
+    def _merge(self):
+        # fusione lineare: copie di slice (in C) tra un id nuovo e il successivo
+        ids, fps, prev = array("q"), array("I"), 0
+        for uid, fp in sorted(self._recent.items()):
+            i = bisect_left(self._ids, uid, prev)
+            ids.extend(self._ids[prev:i]); fps.extend(self._fps[prev:i])
+            ids.append(uid); fps.append(fp)
+            prev = i
+        ids.extend(self._ids[prev:]); fps.extend(self._fps[prev:])
+        self._ids, self._fps, self._recent = ids, fps, {}
+
+    def discard(self, uid: int):
+        self._recent.pop(uid, None)
+        i = self._pos(uid)
+        if i >= 0:
+            del self._ids[i]
+            del self._fps[i]
+
+    def nbytes(self) -> int:
+        return (len(self._ids) * self._ids.itemsize + len(self._fps) * self._fps.itemsize
+                + sys.getsizeof(self._recent))
+
+USER_INDEX = UserIndex()
+
+# ---------- WRITE-BEHIND (registrazioni / profili) ----------
+class WriteBehind:
+    """Scritture accodate dagli handler (mai await sul disco) e applicate da un solo writer.
+
+    put(key, sql, params): per la stessa key vince l'ultimo params di ogni sql. Ogni sql
+    diventa un executemany; gli statement vengono eseguiti nell'ordine di `order` (es. INSERT
+    prima dell'UPDATE), gli altri dopo. Il writer fa flush ogni WB_FLUSH_MS o appena si
+    superano WB_MAX_BATCH chiavi, in un'unica transazione.
+    """
+
+    def __init__(self, flush_ms: int, max_batch: int, order: list):
+        self.flush_s = flush_ms / 1000
+        self.max_batch = max_batch
+        self.order = order
+        self._pending = {}   # key -> {sql: params}
+        self._wake = aio.Event()
+        self._lock = aio.Lock()
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def put(self, key, sql: str, params: tuple):
+        self._pending.setdefault(key, {})[sql] = params
+        if len(self._pending) >= self.max_batch:
+            self._wake.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = _spawn(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await aio.wait_for(self._wake.wait(), timeout=self.flush_s)
+            except aio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            groups = {}
+            for ops in batch.values():
+                for sql, params in ops.items():
+                    groups.setdefault(sql, []).append(params)
+            rank = {sql: i for i, sql in enumerate(self.order)}
+            groups = dict(sorted(groups.items(), key=lambda g: rank.get(g[0], len(rank))))
+            t0 = perf_counter()
+            try:
+                await db_call(_q_apply_batch, groups)
+            except Exception as e:
+                logger.error(f"write-behind: flush di {len(batch)} record fallito: {e}")
+                for key, ops in batch.items():   # si riprova al prossimo giro, senza perdere dati
+                    for sql, params in ops.items():
+                        self._pending.setdefault(key, {}).setdefault(sql, params)
+                return
+            METRICS.observe("write_behind", "flush", perf_counter() - t0)
+            METRICS.inc(("write_behind_records",), len(batch))
+
+    async def close(self):
+        """Arresto ordinato: ferma il writer e scrive tutto ciò che è in coda."""
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except aio.CancelledError: pass
+            self._task = None
+        await self.flush()
+
+WRITE_BEHIND = WriteBehind(WB_FLUSH_MS, WB_MAX_BATCH, [SQL_INSERT_USER, SQL_UPDATE_PROFILE])
+
+# ---------- STATO UI PER UTENTE ----------
+# Id dei messaggi del blocco aperto di ogni utente: LRU limitata in memoria (UI_STATE_MAX)
+# e tabella ui_state scritta via write-behind, così anche dopo un riavvio il blocco si può
+# chiudere. Telegram cancella solo messaggi di meno di 48h: oltre, lo stato non serve più
+# e lo sweeper lo elimina.
+DELETE_WINDOW_S = 48 * 3600
+DELETE_CHUNK = 100   # max id per deleteMessages
+
+SQL_UI_PUT = """INSERT INTO ui_state(user_id, chat_id, msg_ids, updated_ts) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET chat_id=excluded.chat_id,
+                    msg_ids=excluded.msg_ids, updated_ts=excluded.updated_ts"""
+
+def _now_ts() -> float:
+    return datetime.now(timezone.utc).timestamp()
+
+def _q_ui_get(conn, uid: int):
+    r = conn.execute("SELECT chat_id, msg_ids, updated_ts FROM ui_state WHERE user_id=?", (uid,)).fetchone()
+    if not r:
+        return None
+    return r[0], tuple(int(x) for x in r[1].split(",") if x), r[2]
+
+def _q_ui_sweep(conn, cutoff: float) -> int:
+    with conn:
+        return conn.execute("DELETE FROM ui_state WHERE msg_ids='' OR updated_ts < ?", (cutoff,)).rowcount
+
+class UIState:
+    """user_id -> (chat_id, (msg_id, ...), ts). Anche i "nessun blocco" restano in LRU,
+    così i click ripetuti non tornano su SQLite."""
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._lru = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def _remember(self, uid: int, entry: tuple):
+        self._lru[uid] = entry
+        self._lru.move_to_end(uid)
+        while len(self._lru) > self.max_items:
+            self._lru.popitem(last=False)
+
+    async def get(self, uid: int) -> tuple:
+        entry = self._lru.get(uid)
+        if entry is None:
+            entry = await db_call(_q_ui_get, uid) or (0, (), 0.0)
+        self._remember(uid, entry)
+        if entry[1] and entry[2] < _now_ts() - DELETE_WINDOW_S:
+            return entry[0], ()   # scaduto: non più cancellabile
+        return entry[0], entry[1]
+
+    def set(self, uid: int, chat_id: int, ids):
+        ids, ts = tuple(ids), _now_ts()
+        self._remember(uid, (chat_id, ids, ts))
+        WRITE_BEHIND.put(("ui", uid), SQL_UI_PUT, (uid, chat_id, ",".join(map(str, ids)), ts))
+
+    async def take(self, uid: int) -> tuple:
+        """(chat_id, ids) del blocco aperto; lo stato viene azzerato."""
+        chat_id, ids = await self.get(uid)
+        if ids:
+            self.set(uid, chat_id, ())
+        return chat_id, ids
+
+    def expire(self, cutoff: float):
+        for uid in [u for u, e in self._lru.items() if e[2] < cutoff]:
+            del self._lru[uid]
+
+    def clear(self):
+        self._lru.clear()
+
+UI_STATE = UIState(UI_STATE_MAX)
+
+async def delete_messages_bulk(bot, chat_id: int, ids):
+    """deleteMessages a blocchi da 100; gli id già spariti vengono saltati da Telegram."""
+    ids = list(ids)
+    for i in range(0, len(ids), DELETE_CHUNK):
+        try:
+            await bot.delete_messages(chat_id, ids[i:i + DELETE_CHUNK])
+        except tgerr.BadRequest as e:   # es. messaggi oltre le 48h
+            logger.info(f"delete_messages chat {chat_id}: {e}")
+        except tgerr.TelegramError as e:
+            logger.warning(f"delete_messages chat {chat_id} fallito: {e}")
+
+async def ui_state_sweeper():
+    while True:
+        await aio.sleep(UI_SWEEP_MINUTES * 60)
+        cutoff = _now_ts() - DELETE_WINDOW_S
+        try:
+            await WRITE_BEHIND.flush()   # prima le scritture in coda, poi la pulizia
+            n = await db_call(_q_ui_sweep, cutoff)
+            UI_STATE.expire(cutoff)
+            if n:
+                logger.info(f"Stato UI: rimossi {n} blocchi scaduti/vuoti")
+        except Exception as e:
+            logger.warning(f"Sweeper stato UI fallito: {e}")
+
+async def reload_db_caches():
+    """Da chiamare dopo ogni sostituzione del DB (es. /restore_db)."""
+    USER_INDEX.load(*await db_call(_q_known_users))
+    UI_STATE.clear()
+    _media_cache.clear()
+    _media_cache.update(await db_call(_q_media_all))
 
 def add_user_if_new(user):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM users WHERE user_id=?", (user.id,))
-    if not cur.fetchone():
-        cur.execute("INSERT INTO users VALUES (?, ?, ?, ?, ?)",
-                    (user.id, user.username or "", user.first_name or "",
-                     user.last_name or "", datetime.now(timezone.utc).isoformat(timespec="seconds")))
-        conn.commit()
-    conn.close()
+    """Registra l'utente o ne aggiorna il profilo; non tocca il disco (write-behind)."""
+    fp = _profile_fp(user.username, user.first_name, user.last_name)
+    known = USER_INDEX.get(user.id)
+    if known == fp:
+        return   # utente già noto e profilo invariato
+    row = (user.username or "", user.first_name or "", user.last_name or "")
+    key = ("user", user.id)
+    if known is None:   # nuovo, oppure segnato inattivo da un broadcast
+        WRITE_BEHIND.put(key, SQL_INSERT_USER,
+                         (user.id, *row, datetime.now(timezone.utc).isoformat(timespec="seconds")))
+    WRITE_BEHIND.put(key, SQL_UPDATE_PROFILE, (*row, user.id, *row))
+    USER_INDEX.set(user.id, fp)
+
+# ---------- STATISTICHE (contatori in memoria + aggregati giornalieri) ----------
+# Gli handler chiamano STATS.hit(): un += su un dict e, per gli utenti unici, un HyperLogLog
+# per giorno (4 KB, errore ~1.6%). Ogni STATS_FLUSH_S i contatori vengono sommati in
+# stats_daily e i registri HLL fusi (max) in stats_uniques; /stats legge solo queste tabelle.
+STATS_FLUSH_S = 60
+_M64 = (1 << 64) - 1
+
+def _mix64(x: int) -> int:
+    """splitmix64: hash veloce e ben distribuito per gli user_id."""
+    x = (x + 0x9E3779B97F4A7C15) & _M64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _M64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _M64
+    return x ^ (x >> 31)
+
+class HyperLogLog:
+    P = 12
+    M = 1 << P
+    _INV = [2.0 ** -r for r in range(65)]
+
+    def __init__(self, regs: bytes = b""):
+        self.regs = bytearray(regs or self.M)
+
+    def add(self, uid: int):
+        h = _mix64(uid)
+        i = h >> (64 - self.P)
+        rank = (64 - self.P) - (h & ((1 << (64 - self.P)) - 1)).bit_length() + 1
+        if rank > self.regs[i]:
+            self.regs[i] = rank
+
+    def merge(self, other: bytes):
+        self.regs = bytearray(map(max, self.regs, other))
+
+    def count(self) -> int:
+        m = self.M
+        est = 0.7213 / (1 + 1.079 / m) * m * m / sum(self._INV[r] for r in self.regs)
+        zeros = self.regs.count(0)
+        if est <= 2.5 * m and zeros:   # pochi elementi: linear counting
+            est = m * log(m / zeros)
+        return round(est)
+
+def _epoch_day() -> int:
+    return int(_now_ts() // 86400)
+
+def _day_iso(d: int) -> str:
+    return (datetime(1970, 1, 1) + timedelta(days=d)).date().isoformat()
+
+def _q_stats_flush(conn, counts: dict, uniques: dict):
+    with conn:
+        conn.executemany("""INSERT INTO stats_daily(day, metric, n) VALUES (?, ?, ?)
+                            ON CONFLICT(day, metric) DO UPDATE SET n = n + excluded.n""",
+                         [(_day_iso(d), metric, n) for (d, metric), n in counts.items()])
+        for d, regs in uniques.items():
+            day = _day_iso(d)
+            row = conn.execute("SELECT hll FROM stats_uniques WHERE day=?", (day,)).fetchone()
+            if row:
+                hll = HyperLogLog(regs)
+                hll.merge(row[0])
+                regs = bytes(hll.regs)
+            conn.execute("INSERT INTO stats_uniques(day, hll) VALUES (?, ?) "
+                         "ON CONFLICT(day) DO UPDATE SET hll=excluded.hll", (day, regs))
+
+def _q_stats(conn, today: int, days: int = 30) -> dict:
+    """Aggregati per /stats (nel thread DB: anche le fusioni HLL restano fuori dal loop)."""
+    since = _day_iso(today - days + 1)
+    per_day = defaultdict(dict)
+    for day, metric, n in conn.execute("SELECT day, metric, n FROM stats_daily WHERE day >= ?", (since,)):
+        per_day[day][metric] = n
+    hlls = dict(conn.execute("SELECT day, hll FROM stats_uniques WHERE day >= ?", (since,)).fetchall())
+    for day, regs in hlls.items():
+        per_day[day]["dau"] = HyperLogLog(regs).count()
+    union = {}
+    for span in (7, days):
+        hll = HyperLogLog()
+        for d in range(today - span + 1, today + 1):
+            if _day_iso(d) in hlls:
+                hll.merge(hlls[_day_iso(d)])
+        union[span] = hll.count()
+    return {"per_day": per_day, "wau": union[7], "mau": union[days], "users": _q_count_users(conn)}
+
+class Stats:
+    def __init__(self):
+        self._counts = defaultdict(int)   # (giorno, metrica) -> eventi non ancora scritti
+        self._hll = {}                    # giorno -> HyperLogLog del giorno
+        self._dirty = set()
+        self._lock = aio.Lock()
+
+    def hit(self, metric: str, uid: int = 0):
+        d = _epoch_day()
+        self._counts[(d, metric)] += 1
+        if uid:
+            hll = self._hll.get(d)
+            if hll is None:
+                hll = self._hll[d] = HyperLogLog()
+            hll.add(uid)
+            self._dirty.add(d)
+
+    async def flush(self):
+        async with self._lock:
+            if not self._counts and not self._dirty:
+                return
+            counts, self._counts = self._counts, defaultdict(int)
+            uniques = {d: bytes(self._hll[d].regs) for d in self._dirty}
+            self._dirty = set()
+            try:
+                await db_call(_q_stats_flush, counts, uniques)
+            except Exception as e:
+                logger.warning(f"Statistiche: flush fallito, riprovo al prossimo giro: {e}")
+                for k, n in counts.items():
+                    self._counts[k] += n
+                self._dirty |= set(uniques)
+                return
+            today = _epoch_day()
+            for d in [d for d in self._hll if d < today and d not in self._dirty]:
+                del self._hll[d]   # giorni chiusi: i registri sono ormai nel DB
+
+    async def run(self):
+        while True:
+            await aio.sleep(STATS_FLUSH_S)
+            await self.flush()
+
+STATS = Stats()
 
 # ---------- BACKUP + RETENTION ----------
-def make_backup_copy(src: str, dest_dir: str) -> Path:
-    Path(dest_dir).mkdir(parents=True, exist_ok=True)
+# I backup girano in un worker thread con connessioni proprie (backup API a pagine), vengono
+# compressi e registrati in BACKUP_DIR/manifest.json con hash SHA-256 del DB: la retention
+# legge il manifest invece di rifare glob della cartella.
+_manifest_lock = threading.Lock()
+MANIFEST_NAME = "manifest.json"
+
+def _manifest_path(dest_dir: str) -> Path:
+    return Path(dest_dir) / MANIFEST_NAME
+
+def _manifest_bootstrap(dest_dir: str) -> list:
+    """Prima esecuzione: indicizza i file già presenti (unico glob)."""
+    entries = []
+    for p in sorted(Path(dest_dir).glob("users_*_*")):
+        kind = "backup" if p.name.startswith("users_backup_") else "export"
+        st = p.stat()
+        entries.append({"name": p.name, "kind": kind, "ts": st.st_mtime, "size": st.st_size, "sha256": None})
+    return entries
+
+def _manifest_load(dest_dir: str) -> list:
+    path = _manifest_path(dest_dir)
+    if not path.exists():
+        return _manifest_bootstrap(dest_dir)
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["entries"]
+
+def _manifest_save(dest_dir: str, entries: list):
+    path = _manifest_path(dest_dir)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"entries": entries}, f, indent=1)
+    os.replace(tmp, path)
+
+def manifest_add(dest_dir: str, entry: dict):
+    with _manifest_lock:
+        # al primo giro il bootstrap trova già il file appena scritto: una voce per nome
+        entries = [e for e in _manifest_load(dest_dir) if e["name"] != entry["name"]]
+        entries.append(entry)
+        _manifest_save(dest_dir, entries)
+
+def manifest_touch(dest_dir: str, name: str):
+    """Aggiorna ts di una voce (backup identico confermato ora): la retention per età
+    conta dall'ultima volta che il contenuto era ancora quello del DB."""
+    with _manifest_lock:
+        entries = _manifest_load(dest_dir)
+        for e in entries:
+            if e["name"] == name:
+                e["ts"] = datetime.now().timestamp()
+                _manifest_save(dest_dir, entries)
+                return e
+    return None
+
+def last_backup_entry(dest_dir: str):
+    with _manifest_lock:
+        backups = [e for e in _manifest_load(dest_dir) if e["kind"] == "backup"]
+    return backups[-1] if backups else None
+
+def _compressor(fh):
+    """(writer compresso, estensione) secondo BACKUP_COMPRESS; zstd solo se 'zstandard' è installato."""
+    if BACKUP_COMPRESS == "zstd":
+        try:
+            import zstandard
+            return zstandard.ZstdCompressor(level=10).stream_writer(fh, closefd=False), ".zst"
+        except ImportError:
+            logger.warning("BACKUP_COMPRESS=zstd ma 'zstandard' non è installato: uso gzip")
+    return gzip.GzipFile(fileobj=fh, mode="wb", mtime=0), ".gz"
+
+def _decompressor(fh, name: str):
+    """Lettore per un .gz/.zst (es. un backup scaricato da /backup_db); None se non compresso."""
+    if name.endswith(".gz"):
+        return gzip.GzipFile(fileobj=fh, mode="rb")
+    if name.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("file .zst ma 'zstandard' non è installato")
+        return zstandard.ZstdDecompressor().stream_reader(fh)
+    return None
+
+def _unique_backup_path(dest_dir: str) -> Path:
+    """users_backup_<ts>.db mai usato prima (neanche compresso): due backup nello stesso
+    secondo non si sovrascrivono."""
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    dest = Path(dest_dir) / f"users_backup_{ts}.db"
-    src_conn = sqlite3.connect(src)
-    dst_conn = sqlite3.connect(dest)
-    with dst_conn:
-        src_conn.backup(dst_conn)  # copia consistente anche a caldo
-    dst_conn.close(); src_conn.close()
-    return dest
+    for n in range(1, 1000):
+        stem = f"users_backup_{ts}" + (f"_{n}" if n > 1 else "")
+        path = Path(dest_dir) / f"{stem}.db"
+        if any(Path(dest_dir).glob(stem + ".db*")):
+            continue
+        try:
+            path.open("x").close()   # nome riservato (anche contro un backup parallelo)
+            return path
+        except FileExistsError:
+            continue
+    raise FileExistsError(f"troppi backup con timestamp {ts}")
+
+def make_backup_copy(src: str, dest_dir: str, progress=None) -> dict:
+    """Backup a caldo di src in dest_dir; da eseguire in un worker thread.
+
+    progress(copiate, totali) viene chiamata dopo ogni step di BACKUP_PAGES pagine.
+    Restituisce la voce del manifest (non ancora registrata).
+    """
+    Path(dest_dir).mkdir(parents=True, exist_ok=True)
+    raw = _unique_backup_path(dest_dir)
+    restarts = [0, None]
+
+    def _step(status, remaining, total):
+        if restarts[1] is not None and remaining > restarts[1]:
+            restarts[0] += 1   # il DB è cambiato durante la copia: SQLite riparte da capo
+            if restarts[0] > 3:
+                raise sqlite3.OperationalError("backup ripartito troppe volte")
+        restarts[1] = remaining
+        if progress:
+            progress(total - remaining, total)
+
+    # hash del DB (per riconoscere i backup identici) e compressione in un solo passaggio
+    digest = hashlib.sha256()
+    dest = raw
+    part = Path(str(raw) + ".part")
+    try:
+        with DB_FILE_GATE.reading():
+            src_conn = sqlite3.connect(src, timeout=10)
+            dst_conn = sqlite3.connect(raw)
+            try:
+                try:
+                    src_conn.backup(dst_conn, pages=BACKUP_PAGES, progress=_step)
+                except sqlite3.OperationalError as e:
+                    logger.info(f"backup a pagine interrotto ({e}): copia in un solo step")
+                    src_conn.backup(dst_conn)   # snapshot unico: in WAL non blocca gli scrittori
+            finally:
+                dst_conn.close(); src_conn.close()
+
+        with open(raw, "rb") as fin:
+            if BACKUP_COMPRESS == "none":
+                for chunk in iter(lambda: fin.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            else:
+                with open(part, "wb") as fout:
+                    comp, ext = _compressor(fout)
+                    for chunk in iter(lambda: fin.read(1024 * 1024), b""):
+                        digest.update(chunk)
+                        comp.write(chunk)
+                    comp.close()
+                dest = Path(str(raw) + ext)
+        if dest != raw:
+            os.replace(part, dest)
+            raw.unlink(missing_ok=True)
+    except BaseException:
+        # copia o compressione fallita: niente file orfani (la retention vede solo il manifest)
+        for p in (raw, part):
+            p.unlink(missing_ok=True)
+        raise
+    return {"name": dest.name, "kind": "backup", "ts": datetime.now().timestamp(),
+            "size": dest.stat().st_size, "sha256": digest.hexdigest()}
+
+def run_backup(dest_dir: str, progress=None, skip_identical: bool = True):
+    """Crea, deduplica e registra un backup. Restituisce (voce, nuovo?)."""
+    entry = make_backup_copy(DB_FILE, dest_dir, progress)
+    last = last_backup_entry(dest_dir)
+    if skip_identical and last and last.get("sha256") == entry["sha256"] \
+            and (Path(dest_dir) / last["name"]).exists():
+        if entry["name"] != last["name"]:
+            (Path(dest_dir) / entry["name"]).unlink(missing_ok=True)
+        return manifest_touch(dest_dir, last["name"]) or last, False
+    manifest_add(dest_dir, entry)
+    return entry, True
 
 def cleanup_old_backups(dest_dir: str, retention_days: int):
+    """Retention su manifest: età massima, numero massimo e spazio totale (il backup più recente resta)."""
     try:
-        cutoff = datetime.now() - timedelta(days=retention_days)
-        for path in glob.glob(str(Path(dest_dir) / "users_backup_*.db")):
-            p = Path(path)
-            if datetime.fromtimestamp(p.stat().st_mtime) < cutoff:
-                p.unlink(missing_ok=True)
-        for pattern in ["users_export_*.csv", "users_export_*.json", "users_export_*.xlsx"]:
-            for path in glob.glob(str(Path(dest_dir) / pattern)):
-                p = Path(path)
-                if datetime.fromtimestamp(p.stat().st_mtime) < cutoff:
-                    p.unlink(missing_ok=True)
+        with _manifest_lock:
+            entries = _manifest_load(dest_dir)
+            cutoff = (datetime.now() - timedelta(days=retention_days)).timestamp()
+            entries = [e for e in entries if (Path(dest_dir) / e["name"]).exists()]
+            # il backup più recente si sceglie fra tutti, prima del filtro per età: mai zero backup
+            newest = max((e for e in entries if e["kind"] == "backup"), key=lambda e: e["ts"], default=None)
+            keep, drop = [], []
+            for e in entries:
+                (drop if e["ts"] < cutoff and e is not newest else keep).append(e)
+            backups = sorted((e for e in keep if e["kind"] == "backup"), key=lambda e: e["ts"])
+            if BACKUP_MAX_COUNT and len(backups) > BACKUP_MAX_COUNT:
+                drop += backups[:len(backups) - BACKUP_MAX_COUNT]
+            if BACKUP_MAX_TOTAL_MB:
+                total = sum(e["size"] for e in keep if e not in drop)
+                for e in keep:
+                    if total <= BACKUP_MAX_TOTAL_MB * 1024 * 1024:
+                        break
+                    if e not in drop and e is not newest:
+                        drop.append(e); total -= e["size"]
+            if newest in drop:
+                drop.remove(newest)
+            for e in drop:
+                (Path(dest_dir) / e["name"]).unlink(missing_ok=True)
+            _manifest_save(dest_dir, [e for e in keep if e not in drop])
     except Exception as e:
         logger.warning(f"cleanup_old_backups: {e}")
 
+# ---------- CACHE MEDIA (file_id) ----------
+# Dopo il primo invio riusiamo il file_id di Telegram: niente nuovo download dell'URL
+# né nuovo upload. Chiave = tipo + sorgente (per i file locali anche size/mtime).
+_media_cache = {}   # source_key -> file_id
+
+def _q_media_all(conn):
+    return dict(conn.execute("SELECT source, file_id FROM media_cache"))
+
+def _q_media_put(conn, key: str, file_id: str):
+    conn.execute("INSERT INTO media_cache(source, file_id, updated_utc) VALUES (?, ?, ?) "
+                 "ON CONFLICT(source) DO UPDATE SET file_id=excluded.file_id, updated_utc=excluded.updated_utc",
+                 (key, file_id, datetime.now(timezone.utc).isoformat(timespec="seconds")))
+    conn.commit()
+
+def _q_media_del(conn, key: str):
+    conn.execute("DELETE FROM media_cache WHERE source=?", (key,))
+    conn.commit()
+
+def _media_key(kind: str, source: str, local: bool) -> str:
+    if local:
+        st = os.stat(source)
+        return f"{kind}:file:{os.path.abspath(source)}:{st.st_size}:{int(st.st_mtime)}"
+    return f"{kind}:{source}"
+
+def _sent_file_id(msg, kind: str):
+    if kind == "photo":
+        return msg.photo[-1].file_id if msg.photo else None
+    media = getattr(msg, kind, None)
+    return media.file_id if media else None
+
+async def send_cached_media(chat, kind: str, source: str, local: bool = False, **kwargs):
+    """chat.send_<kind>() con cache del file_id; se Telegram lo rifiuta si ricarica la sorgente."""
+    send = getattr(chat, f"send_{kind}")
+    key = _media_key(kind, source, local)
+    file_id = _media_cache.get(key)
+    if file_id:
+        try:
+            return await send(file_id, **kwargs)
+        except tgerr.BadRequest as e:
+            logger.warning(f"file_id in cache rifiutato ({key}): {e} — ricarico")
+            _media_cache.pop(key, None)
+            await db_call(_q_media_del, key)
+    if local:
+        with open(source, "rb") as fh:
+            msg = await send(fh, **kwargs)
+    else:
+        msg = await send(source, **kwargs)
+    file_id = _sent_file_id(msg, kind)
+    if file_id:
+        _media_cache[key] = file_id
+        await db_call(_q_media_put, key, file_id)
+    return msg
+
 # ---------- INTERFACCIA ----------
+# Menù e contatti vengono divisi in pagine una sola volta all'avvio e mostrati in UN
+# messaggio con ◀️/▶️: la navigazione modifica quel messaggio invece di inviarne altri.
+PAGE_LIMIT = 4000   # Telegram: max 4096 unità UTF-16 per messaggio
+
+def _utf16_len(s: str) -> int:
+    return len(s.encode("utf-16-le")) // 2
+
+def _pack(text: str, limit: int, seps=("\n\n", "\n", " ")) -> list:
+    """Spezza text in blocchi <= limit preferendo paragrafi, poi righe, poi parole."""
+    if _utf16_len(text) <= limit:
+        return [text]
+    if not seps:   # parola enorme: taglio per caratteri (mai a metà di un code point)
+        out, cur = [], ""
+        for ch in text:
+            if _utf16_len(cur + ch) > limit:
+                out.append(cur); cur = ""
+            cur += ch
+        return out + [cur] if cur else out
+    sep, out, cur = seps[0], [], ""
+    for piece in text.split(sep):
+        for sub in _pack(piece, limit, seps[1:]):
+            cand = f"{cur}{sep}{sub}" if cur else sub
+            if cur and _utf16_len(cand) > limit:
+                out.append(cur); cur = sub
+            else:
+                cur = cand
+    if cur:
+        out.append(cur)
+    return out
+
+def paginate(text: str, limit: int = PAGE_LIMIT) -> list:
+    return [p.strip() for p in _pack(text, limit) if p.strip()] or ["-"]
+
+PAGES = {"menu": paginate(MENU_TEXT), "contacts": paginate(CONTACTS_TEXT)}
+HOME_TEXT = f"{WELCOME_TITLE}\n\nScegli una voce dal menu qui sotto:"
+
 def kb_home():
     return InlineKeyboardMarkup([[
         InlineKeyboardButton(BTN_MENU, callback_data="open_menu"),
@@ -156,37 +1432,49 @@ def kb_home():
 def kb_back():
     return InlineKeyboardMarkup([[InlineKeyboardButton(BTN_BACK, callback_data="home")]])
 
+def kb_pages(key: str, i: int, n: int):
+    if n <= 1:
+        return kb_back()
+    nav = [
+        InlineKeyboardButton("◀️" if i > 0 else " ", callback_data=f"pg:{key}:{i - 1}" if i > 0 else "noop"),
+        InlineKeyboardButton(f"{i + 1}/{n}", callback_data="noop"),
+        InlineKeyboardButton("▶️" if i < n - 1 else " ", callback_data=f"pg:{key}:{i + 1}" if i < n - 1 else "noop"),
+    ]
+    return InlineKeyboardMarkup([nav, [InlineKeyboardButton(BTN_BACK, callback_data="home")]])
+
 async def show_home_with_photo(chat):
-    caption = f"{WELCOME_TITLE}\n\nScegli una voce dal menu qui sotto:"
-    await chat.send_photo(photo=WELCOME_PHOTO_URL, caption=caption, reply_markup=kb_home(), protect_content=True)
+    local = bool(WELCOME_PHOTO_FILE) and Path(WELCOME_PHOTO_FILE).is_file()
+    await send_cached_media(chat, "photo", WELCOME_PHOTO_FILE if local else WELCOME_PHOTO_URL, local=local,
+                            caption=HOME_TEXT, reply_markup=kb_home(), protect_content=True)
 
 def _chunks(s: str, size: int = 3800):
     for i in range(0, len(s), size): yield s[i:i+size]
 
-async def send_long_with_back(update_or_chat, context, text: str):
-    if hasattr(update_or_chat, "effective_chat") and update_or_chat.effective_chat:
-        chat = update_or_chat.effective_chat
-    elif hasattr(update_or_chat, "message") and hasattr(update_or_chat.message, "chat"):
-        chat = update_or_chat.message.chat
-    else:
-        chat = update_or_chat
-    sent_ids = []
-    parts = list(_chunks(text, 3800))
-    if not parts: return
-    for p in parts[:-1]:
-        m = await chat.send_message(p, protect_content=True)
-        sent_ids.append(m.message_id)
-    last = await chat.send_message(parts[-1], reply_markup=kb_back(), protect_content=True)
-    sent_ids.append(last.message_id)
-    context.user_data[OPEN_KEY] = sent_ids
+async def _edit_panel(q, text: str, markup):
+    try:
+        await q.edit_message_text(text, reply_markup=markup)
+    except tgerr.BadRequest as e:
+        if "not modified" not in str(e).lower():   # doppio click sullo stesso pulsante
+            raise
+
+async def show_pages(update, context, key: str, page: int = 0):
+    q = update.callback_query
+    pages = PAGES[key]
+    page = max(0, min(page, len(pages) - 1))
+    text, markup = pages[page], kb_pages(key, page, len(pages))
+    if getattr(q.message, "text", None) is not None:
+        await _edit_panel(q, text, markup)   # già nel pannello testuale: modifica in place
+        return
+    # click dalla foto di benvenuto: un solo messaggio nuovo, il pannello precedente si chiude
+    await delete_open_block(update, context)
+    chat = update.effective_chat
+    m = await chat.send_message(text, reply_markup=markup, protect_content=True)
+    UI_STATE.set(update.effective_user.id, chat.id, [m.message_id])
 
 async def delete_open_block(update, context):
-    ids = context.user_data.get(OPEN_KEY, [])
-    chat_id = update.effective_chat.id
-    for mid in ids:
-        try: await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-        except: pass
-    context.user_data[OPEN_KEY] = []
+    chat_id, ids = await UI_STATE.take(update.effective_user.id)
+    if ids:
+        await delete_messages_bulk(context.bot, chat_id, ids)
 
 # ---------- CALLBACK ----------
 async def on_buttons(update, context):
@@ -194,24 +1482,34 @@ async def on_buttons(update, context):
     await q.answer()
     try:
         if q.data == "open_menu":
-            await send_long_with_back(update, context, MENU_TEXT)
+            STATS.hit("menu", q.from_user.id)
+            await show_pages(update, context, "menu")
         elif q.data == "open_contacts":
-            await send_long_with_back(update, context, CONTACTS_TEXT)
+            STATS.hit("contacts", q.from_user.id)
+            await show_pages(update, context, "contacts")
+        elif q.data.startswith("pg:"):
+            _, key, page = q.data.split(":")
+            if key in PAGES:
+                STATS.hit("page", q.from_user.id)
+                await show_pages(update, context, key, int(page))
         elif q.data == "home":
-            await delete_open_block(update, context)
-            try: await q.message.delete()
-            except: pass
-            await show_home_with_photo(q.message.chat)
+            STATS.hit("home", q.from_user.id)
+            if getattr(q.message, "text", None) is not None:
+                await _edit_panel(q, HOME_TEXT, kb_home())
+            else:
+                await show_home_with_photo(update.effective_chat)
     except Exception as e:
         logger.warning(f"on_buttons error: {e}")
 
 # ---------- COMANDI BASE ----------
 async def cmd_start(update, context):
-    if update.effective_user: add_user_if_new(update.effective_user)
+    if update.effective_user:
+        add_user_if_new(update.effective_user)
+        STATS.hit("start", update.effective_user.id)
     await show_home_with_photo(update.effective_chat)
 
 async def cmd_utenti(update, context):
-    n = sqlite3.connect(DB_FILE).execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    n = await db_call(_q_count_users)
     await update.message.reply_text(f"👥 Utenti registrati: {n}", protect_content=True)
 
 async def cmd_status(update, context):
@@ -222,130 +1520,674 @@ async def cmd_whoami(update, context):
     await update.message.reply_text(f"ID: {uid}\nAdmin: {'SI' if is_admin(uid) else 'NO'}", protect_content=True)
 
 # ---------- BLOCCO MEDIA UTENTI (non admin) ----------
+# Le cancellazioni non partono subito: si accumulano per chat per MOD_FLUSH_MS e vanno in
+# un'unica deleteMessages (max 100 id). Un contatore a finestra scorrevole per (chat, utente)
+# fa scattare nei gruppi un mute temporaneo, con durata che raddoppia a ogni recidiva.
+STRIKE_RESET_S = 24 * 3600
+
+class Moderation:
+    def __init__(self):
+        self._pending = {}   # chat_id -> [message_id, ...]
+        self._timers = {}    # chat_id -> task di flush
+        self._hits = {}      # (chat_id, user_id) -> deque di monotonic()
+        self._strikes = {}   # (chat_id, user_id) -> (n. mute, ultimo monotonic())
+        self._muted = {}     # (chat_id, user_id) -> fine mute (monotonic)
+        self._seen = 0
+
+    def add(self, bot, chat, user_id: int, message_id: int):
+        ids = self._pending.setdefault(chat.id, [])
+        ids.append(message_id)
+        if len(ids) >= DELETE_CHUNK:
+            _spawn(self.flush(bot, chat.id))
+        elif chat.id not in self._timers:
+            self._timers[chat.id] = _spawn(self._flush_later(bot, chat.id))
+        if user_id and chat.type in ("group", "supergroup"):
+            self._count(bot, chat.id, user_id)
+
+    async def _flush_later(self, bot, chat_id: int):
+        await aio.sleep(MOD_FLUSH_MS / 1000)
+        self._timers.pop(chat_id, None)
+        await self.flush(bot, chat_id)
+
+    async def flush(self, bot, chat_id: int):
+        ids = self._pending.pop(chat_id, [])
+        for i in range(0, len(ids), DELETE_CHUNK):
+            chunk = ids[i:i + DELETE_CHUNK]
+            METRICS.inc(("mod_delete_calls",))
+            try:
+                await bot.delete_messages(chat_id, chunk)
+                METRICS.inc(("mod_deleted",), len(chunk))
+            except tgerr.TelegramError as e:   # es. bot senza permessi nel gruppo
+                METRICS.inc(("mod_errors", "delete", type(e).__name__))
+                logger.warning(f"Moderazione: deleteMessages chat {chat_id} fallito: {e}")
+
+    async def close(self, bot):
+        for t in self._timers.values():
+            t.cancel()
+        self._timers.clear()
+        for chat_id in list(self._pending):
+            await self.flush(bot, chat_id)
+
+    def _count(self, bot, chat_id: int, user_id: int):
+        now, key = monotonic(), (chat_id, user_id)
+        hits = self._hits.get(key)
+        if hits is None:
+            hits = self._hits[key] = deque()
+        hits.append(now)
+        while hits[0] < now - MOD_WINDOW_S:
+            hits.popleft()
+        self._seen += 1
+        if self._seen % 1000 == 0:
+            self._prune(now)
+        if len(hits) > MOD_MAX_MEDIA and self._muted.get(key, 0) < now:
+            hits.clear()
+            n, last = self._strikes.get(key, (0, now))
+            n = n + 1 if now - last < STRIKE_RESET_S else 1
+            self._strikes[key] = (n, now)
+            secs = min(MOD_MUTE_S * 2 ** (n - 1), MOD_MUTE_MAX_S)
+            self._muted[key] = now + secs
+            _spawn(self._mute(bot, chat_id, user_id, secs, n))
+
+    async def _mute(self, bot, chat_id: int, user_id: int, secs: int, strike: int):
+        until = datetime.now(timezone.utc) + timedelta(seconds=secs)
+        try:
+            await bot.restrict_chat_member(chat_id, user_id, ChatPermissions.no_permissions(), until_date=until)
+            METRICS.inc(("mod_mutes",))
+            logger.info(f"Moderazione: utente {user_id} mutato {secs}s in chat {chat_id} (recidiva {strike})")
+        except tgerr.TelegramError as e:
+            METRICS.inc(("mod_errors", "restrict", type(e).__name__))
+            logger.warning(f"Moderazione: mute di {user_id} in chat {chat_id} fallito: {e}")
+
+    def _prune(self, now: float):
+        """Tiene limitata la memoria: via le finestre vuote, i mute finiti e le recidive scadute."""
+        self._hits = {k: h for k, h in self._hits.items() if h and h[-1] >= now - MOD_WINDOW_S}
+        self._muted = {k: t for k, t in self._muted.items() if t >= now}
+        self._strikes = {k: v for k, v in self._strikes.items() if now - v[1] < STRIKE_RESET_S}
+
+    def stats(self) -> dict:
+        self._prune(monotonic())
+        return {"pending": sum(map(len, self._pending.values())), "tracked": len(self._hits),
+                "muted": len(self._muted),
+                "top": sorted(self._strikes.items(), key=lambda kv: -kv[1][0])[:5]}
+
+MODERATION = Moderation()
+
 async def block_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancella foto/video/documenti/voice/animazioni/sticker inviati da non-admin."""
     u = update.effective_user
     if u and is_admin(u.id):
         return
-    chat = update.effective_chat
-    try:
-        await context.bot.delete_message(chat_id=chat.id, message_id=update.effective_message.id)
-    except Exception:
-        pass
+    MODERATION.add(context.bot, update.effective_chat, u.id if u else 0, update.effective_message.id)
 
 # ---------- COMANDI ADMIN (solo privato) ----------
 async def cmd_adminstatus(update, context):
     if not admin_only_private(update): return
-    n = sqlite3.connect(DB_FILE).execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    n = await db_call(_q_count_users)
+    idx_n, idx_bytes = len(USER_INDEX), USER_INDEX.nbytes()
+    per_million = idx_bytes / max(idx_n, 1) * 1_000_000
     await update.message.reply_text(
         f"🔐 Admin Status\n"
         f"🗂 DB: {DB_FILE}\n"
         f"📦 Backup: {BACKUP_DIR}\n"
         f"⏰ Auto-backup (UTC): {BACKUP_TIME}\n"
         f"🧹 Retention: {BACKUP_RETENTION_DAYS} giorni\n"
-        f"👥 Utenti: {n}",
+        f"👥 Utenti: {n}\n"
+        f"👑 Istanza: {LEASE.holder} ({'leader' if LEASE.is_leader else 'standby'})\n"
+        f"🧠 Indice utenti: {idx_n} id, {idx_bytes / 1024:.0f} KB (≈{per_million / 1048576:.1f} MB per milione)",
         protect_content=True
     )
 
-async def cmd_backup_db(update, context):
+def _ms(v: float) -> str:
+    return f"{v * 1000:.0f}ms" if v >= 0.001 else f"{v * 1e6:.0f}µs"
+
+async def cmd_perf(update, context):
     if not admin_only_private(update): return
-    p = make_backup_copy(DB_FILE, BACKUP_DIR)
-    with open(p, "rb") as fh:
-        await update.message.reply_document(document=fh, filename=p.name, caption=f"Backup creato: {p.name}", protect_content=True)
+    up = int(monotonic() - METRICS.started)
+    lines = [f"📈 Perf — uptime {up // 3600}h{up % 3600 // 60:02d}m", "", "Handler (n · p50 · p99 · API/chiamata · errori):"]
+    hs = sorted(((lbl, h) for (n, lbl), h in METRICS.hists.items() if n == "handler"), key=lambda x: -x[1].n)
+    for name, h in hs:
+        api = METRICS.counters.get(("handler_api_calls", name), 0)
+        errs = sum(v for k, v in METRICS.counters.items() if k[0] == "handler_errors" and k[1] == name)
+        lines.append(f"• {name}: {h.n} · {_ms(h.quantile(.5))} · {_ms(h.quantile(.99))} · {api / max(h.n, 1):.1f} · {errs}")
+    lines += ["", "Bot API (n · p50 · p99):"]
+    api = sorted(((lbl, h) for (n, lbl), h in METRICS.hists.items() if n == "api"), key=lambda x: -x[1].n)
+    for name, h in api[:12]:
+        lines.append(f"• {name}: {h.n} · {_ms(h.quantile(.5))} · {_ms(h.quantile(.99))}")
+    api_errs = [(k[1], k[2], v) for k, v in METRICS.counters.items() if k[0] == "api_errors"]
+    for name, exc, v in sorted(api_errs, key=lambda x: -x[2])[:5]:
+        lines.append(f"  ⚠️ {name} {exc}: {v}")
+    db = [h for (n, _), h in METRICS.hists.items() if n == "db"]
+    db_n, db_t = sum(h.n for h in db), sum(h.total for h in db)
+    lines += ["", f"DB: {db_n} query, media {_ms(db_t / max(db_n, 1))}"]
+    wb = METRICS.hists.get(("write_behind", "flush"))
+    if wb:
+        lines.append(f"Write-behind: coda {len(WRITE_BEHIND)}, {wb.n} flush "
+                     f"(p50 {_ms(wb.quantile(.5))}, p99 {_ms(wb.quantile(.99))}), "
+                     f"{METRICS.counters.get(('write_behind_records',), 0)} record")
+    for lane in ("user", "admin"):
+        h = METRICS.hists.get(("lane_wait", lane))
+        if h:
+            lines.append(f"Corsia {lane}: {h.n} update, attesa p50 {_ms(h.quantile(.5))}, "
+                         f"p99 {_ms(h.quantile(.99))}, max {_ms(h.max)}")
+    for lane, req in InstrumentedRequest.lanes.items():
+        h = METRICS.hists.get(("http_pool_wait", lane))
+        if h:
+            sat = METRICS.counters.get(("http_pool_saturated", lane), 0)
+            tmo = METRICS.counters.get(("http_pool_timeouts", lane), 0)
+            lines.append(f"HTTP {lane}: {req.in_flight}/{req.pool_size} in uso, attesa pool p99 "
+                         f"{_ms(h.quantile(.99))} (max {_ms(h.max)}), pool pieno {sat}×, timeout {tmo}")
+    lag = METRICS.hists.get(("loop_lag", "event_loop"))
+    if lag:
+        lines.append(f"Event loop lag: p99 {_ms(lag.quantile(.99))}, max {_ms(lag.max)}")
+    text = "\n".join(lines)
+    for part in _chunks(text, 3800):
+        await update.message.reply_text(part, protect_content=True)
 
-async def cmd_export(update, context):
+async def cmd_stats(update, context):
     if not admin_only_private(update): return
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, username, first_name, last_name, joined_utc FROM users")
-        rows = cur.fetchall()
-        conn.close()
+    await STATS.flush()   # i numeri includono anche gli ultimi eventi in memoria
+    today = _epoch_day()
+    st = await db_call(_q_stats, today, 30)
+    per_day = st["per_day"]
+    t = per_day.get(_day_iso(today), {})
+    week = [per_day.get(_day_iso(d), {}) for d in range(today - 6, today + 1)]
+    menu, contacts = sum(x.get("menu", 0) for x in week), sum(x.get("contacts", 0) for x in week)
+    lines = [
+        "📊 Statistiche (UTC)",
+        f"👥 Utenti registrati: {st['users']}",
+        f"📈 DAU {t.get('dau', 0)} · WAU {st['wau']} · MAU {st['mau']}",
+        f"🆕 Nuovi oggi: {t.get('new_users', 0)} · 7 giorni: {sum(x.get('new_users', 0) for x in week)}",
+        f"🖱 7 giorni: {BTN_MENU} {menu} · {BTN_CONTACTS} {contacts} · pagine {sum(x.get('page', 0) for x in week)}"
+        + (f" (menù {100 * menu / (menu + contacts):.0f}%)" if menu + contacts else ""),
+        "",
+        "Giorno · attivi · nuovi · /start · menù · contatti",
+    ]
+    for d in range(today, today - 7, -1):
+        x = per_day.get(_day_iso(d), {})
+        lines.append(f"{_day_iso(d)[5:]} · {x.get('dau', 0)} · {x.get('new_users', 0)} · {x.get('start', 0)}"
+                     f" · {x.get('menu', 0)} · {x.get('contacts', 0)}")
+    await update.message.reply_text("\n".join(lines), protect_content=True)
+
+async def cmd_modstats(update, context):
+    if not admin_only_private(update): return
+    c, st = METRICS.counters, MODERATION.stats()
+    deleted, calls = c.get(("mod_deleted",), 0), c.get(("mod_delete_calls",), 0)
+    errs = sum(v for k, v in c.items() if k[0] == "mod_errors")
+    lines = [
+        "🛡 Moderazione media",
+        f"🗑 Cancellati: {deleted} in {calls} chiamate ({deleted / max(calls, 1):.1f}/chiamata)",
+        f"⏳ In attesa di cancellazione: {st['pending']}",
+        f"🔇 Mute applicati: {c.get(('mod_mutes',), 0)} (attivi: {st['muted']})",
+        f"👀 Utenti in finestra ({MOD_WINDOW_S}s): {st['tracked']}",
+        f"⚠️ Errori API: {errs}",
+    ]
+    if st["top"]:
+        lines += ["", "Recidivi (24h):"]
+        lines += [f"• {uid} in {chat_id}: {n} mute" for (chat_id, uid), (n, _) in st["top"]]
+    await update.message.reply_text("\n".join(lines), protect_content=True)
+
+async def cmd_backup_db(update, context):
+    if not admin_only_private(update): return
+    status = await update.message.reply_text("💾 Backup in corso…", protect_content=True)
+    done = {"pct": 0.0}
 
-        Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        csv_path = Path(BACKUP_DIR) / f"users_export_{ts}.csv"
+    def _progress(copied, total):
+        done["pct"] = 100 * copied / total if total else 100.0
 
-        with open(csv_path, "w", newline="", encoding="utf-8-sig") as f:
-            w = csv.writer(f)
-            w.writerow(["user_id","username","first_name","last_name","joined_utc"])
-            w.writerows(rows)
+    async def _report():
+        shown = -1
+        while True:
+            await aio.sleep(1.5)
+            if int(done["pct"]) != shown:
+                shown = int(done["pct"])
+                try: await status.edit_text(f"💾 Backup in corso… {shown}%")
+                except tgerr.TelegramError: pass
 
-        with open(csv_path, "rb") as fh:
-            await update.message.reply_document(document=fh, filename=csv_path.name,
-                                                caption=f"Esportazione utenti: {csv_path.name}",
-                                                protect_content=True)
+    reporter = _spawn(_report())
+    try:
+        entry, is_new = await aio.to_thread(run_backup, BACKUP_DIR, _progress)
     except Exception as e:
-        await update.message.reply_text(f"Errore export: {e}", protect_content=True)
+        await status.edit_text(f"❌ Errore backup: {e}")
+        return
+    finally:
+        reporter.cancel()
+    p = Path(BACKUP_DIR) / entry["name"]
+    note = "creato" if is_new else "invariato rispetto all'ultimo"
+    try: await status.edit_text(f"💾 Backup {note}: {p.name} ({entry['size'] / 1048576:.1f} MB)")
+    except tgerr.TelegramError: pass
+    with open(p, "rb") as fh:
+        await bulk_bot(context.bot).send_document(update.effective_chat.id, document=fh, filename=p.name,
+                                                  caption=f"Backup {note}: {p.name}", protect_content=True)
 
-async def cmd_export_json(update, context):
-    if not admin_only_private(update): return
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, username, first_name, last_name, joined_utc FROM users")
-        rows = cur.fetchall()
-        conn.close()
+# ---------- EXPORT (pipeline condivisa) ----------
+EXPORT_COLUMNS = ["user_id", "username", "first_name", "last_name", "joined_utc"]
 
-        data = [
-            {"user_id": r[0], "username": r[1], "first_name": r[2], "last_name": r[3], "joined_utc": r[4]}
-            for r in rows
-        ]
+def _export_rows(batch: int):
+    """Righe utenti a blocchi da una connessione read-only separata (non blocca il thread DB)."""
+    with DB_FILE_GATE.reading():
+        conn = sqlite3.connect(f"file:{Path(DB_FILE).resolve()}?mode=ro", uri=True)
+        try:
+            cur = conn.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM users ORDER BY user_id")
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+def _text_out(out, encoding="utf-8"):
+    return io.TextIOWrapper(out, encoding=encoding, newline="", write_through=False)
 
-        Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        json_path = Path(BACKUP_DIR) / f"users_export_{ts}.json"
+def _write_csv(rows, out):
+    f = _text_out(out, "utf-8-sig")
+    w = csv.writer(f)
+    w.writerow(EXPORT_COLUMNS)
+    w.writerows(rows)
+    f.flush(); f.detach()
 
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+def _write_json(rows, out):
+    f = _text_out(out)
+    f.write("[")
+    sep = "\n  "
+    for r in rows:
+        f.write(sep)
+        f.write(json.dumps(dict(zip(EXPORT_COLUMNS, r)), ensure_ascii=False))
+        sep = ",\n  "
+    f.write("\n]\n")
+    f.flush(); f.detach()
 
-        with open(json_path, "rb") as fh:
-            await update.message.reply_document(document=fh, filename=json_path.name,
-                                                caption=f"Export JSON: {json_path.name}",
-                                                protect_content=True)
+def _write_ndjson(rows, out):
+    f = _text_out(out)
+    for r in rows:
+        f.write(json.dumps(dict(zip(EXPORT_COLUMNS, r)), ensure_ascii=False))
+        f.write("\n")
+    f.flush(); f.detach()
+
+def _write_xlsx(rows, out):
+    from openpyxl import Workbook   # import pigro: ~0.1s risparmiati a ogni avvio
+    wb = Workbook(write_only=True)   # le righe vengono scritte in streaming, non tenute in memoria
+    ws = wb.create_sheet("Utenti")
+    ws.append(EXPORT_COLUMNS)
+    for r in rows:
+        ws.append(r)
+    wb.save(out)
+
+EXPORT_FORMATS = {
+    "csv": _write_csv,
+    "json": _write_json,
+    "ndjson": _write_ndjson,
+    "xlsx": _write_xlsx,
+}
+
+def build_export(fmt: str, compress: bool = False):
+    """Scrive l'export su un file temporaneo (riavvolto) e ne restituisce (file, nome).
+
+    Da eseguire in un worker thread. L'xlsx è già uno zip: compress viene ignorato.
+    """
+    compress = compress and fmt != "xlsx"
+    name = f"users_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    tmp = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MB * 1024 * 1024)
+    try:
+        if compress:
+            with gzip.GzipFile(filename=name, mode="wb", fileobj=tmp) as gz:
+                EXPORT_FORMATS[fmt](_export_rows(EXPORT_BATCH), gz)
+            name += ".gz"
+        else:
+            EXPORT_FORMATS[fmt](_export_rows(EXPORT_BATCH), tmp)
+        if EXPORT_SAVE_COPY == "1":
+            Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
+            tmp.seek(0)
+            with open(Path(BACKUP_DIR) / name, "wb") as dst:
+                shutil.copyfileobj(tmp, dst)
+            manifest_add(BACKUP_DIR, {"name": name, "kind": "export", "ts": datetime.now().timestamp(),
+                                      "size": tmp.tell(), "sha256": None})
+        tmp.seek(0)
+        return tmp, name
+    except Exception:
+        tmp.close()
+        raise
+
+async def send_export(update, context, fmt: str, caption: str, err_label: str):
+    args = [a.lower() for a in (context.args or [])]
+    if fmt == "json" and "ndjson" in args:
+        fmt = "ndjson"
+    try:
+        fh, name = await aio.to_thread(build_export, fmt, "gz" in args or "gzip" in args)
+        try:
+            await bulk_bot(context.bot).send_document(update.effective_chat.id, document=fh, filename=name,
+                                                      caption=f"{caption}: {name}", protect_content=True)
+        finally:
+            fh.close()
     except Exception as e:
-        await update.message.reply_text(f"Errore export JSON: {e}", protect_content=True)
+        await update.message.reply_text(f"{err_label}: {e}", protect_content=True)
+
+async def cmd_export(update, context):
+    """/export [gz]"""
+    if not admin_only_private(update): return
+    await send_export(update, context, "csv", "Esportazione utenti", "Errore export")
+
+async def cmd_export_json(update, context):
+    """/export_json [ndjson] [gz]"""
+    if not admin_only_private(update): return
+    await send_export(update, context, "json", "Export JSON", "Errore export JSON")
 
 async def cmd_export_xlsx(update, context):
     if not admin_only_private(update): return
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        cur.execute("SELECT user_id, username, first_name, last_name, joined_utc FROM users")
-        rows = cur.fetchall()
-        conn.close()
+    await send_export(update, context, "xlsx", "Export XLSX", "Errore export XLSX")
 
-        Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        xlsx_path = Path(BACKUP_DIR) / f"users_export_{ts}.xlsx"
-
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Utenti"
-        ws.append(["user_id","username","first_name","last_name","joined_utc"])
-        for r in rows:
-            ws.append(list(r))
-        wb.save(xlsx_path)
-
-        with open(xlsx_path, "rb") as fh:
-            await update.message.reply_document(document=fh, filename=xlsx_path.name,
-                                                caption=f"Export XLSX: {xlsx_path.name}",
-                                                protect_content=True)
-    except Exception as e:
-        await update.message.reply_text(f"Errore export XLSX: {e}", protect_content=True)
+# ---------- /list (keyset) e /find ----------
+LIST_PAGE = 25
+
+def _fmt_user(row) -> str:
+    uid, un, fn, joined, active = row
+    return f"• {fn or '-'} @{un or '-'} (ID: {uid}) {(joined or '')[:10]}{'' if active else ' 🚫'}"
+
+def kb_list(rows, has_prev: bool, has_next: bool):
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("◀️ Più recenti", callback_data=f"ls:p:{rows[0][0]}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Più vecchi ▶️", callback_data=f"ls:n:{rows[-1][0]}"))
+    return InlineKeyboardMarkup([nav]) if nav else None
+
+async def _list_page(cursor: int = 0, older: bool = True):
+    rows, more = await db_call(_q_users_page, cursor, older, LIST_PAGE)
+    if not rows:
+        if cursor:   # utente di confine sparito (es. dopo /restore_db): si riparte
+            return await _list_page()
+        return "Nessun utente.", None
+    has_prev, has_next = (bool(cursor), more) if older else (more, True)
+    text = "👥 Utenti, dal più recente:\n\n" + "\n".join(map(_fmt_user, rows))
+    return text, kb_list(rows, has_prev, has_next)
 
 async def cmd_list(update, context):
     if not admin_only_private(update): return
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, username, first_name FROM users ORDER BY joined_utc DESC LIMIT 100")
-    rows = cur.fetchall()
-    conn.close()
+    text, markup = await _list_page()
+    await update.message.reply_text(text, reply_markup=markup, protect_content=True)
+
+async def on_list_buttons(update, context):
+    q = update.callback_query
+    await q.answer()
+    if not admin_only_private(update): return
+    _, direction, cursor = q.data.split(":")
+    text, markup = await _list_page(int(cursor), older=direction == "n")
+    await _edit_panel(q, text, markup)
+
+async def cmd_find(update, context):
+    if not admin_only_private(update): return
+    prefix = " ".join(context.args).strip().lstrip("@")
+    if not prefix:
+        await update.message.reply_text("Uso: /find <inizio di username o nome>", protect_content=True)
+        return
+    rows = await db_call(_q_find_users, prefix, 50)
     if not rows:
-        await update.message.reply_text("Nessun utente.", protect_content=True)
+        await update.message.reply_text(f"Nessun utente per \"{prefix}\".", protect_content=True)
         return
-    msg = "\n".join(f"• {fn or '-'} @{un or '-'} (ID: {uid})" for uid,un,fn in rows)
-    for part in _chunks(msg,3800): await update.message.reply_text(part, protect_content=True)
+    msg = f"🔎 {len(rows)} risultati per \"{prefix}\":\n\n" + "\n".join(map(_fmt_user, rows))
+    for part in _chunks(msg, 3800): await update.message.reply_text(part, protect_content=True)
+
+# ---------- BROADCAST (in background, ripristinabile) ----------
+class TokenBucket:
+    """Limitatore token-bucket condiviso; pause() blocca tutti dopo un RetryAfter."""
+
+    def __init__(self, rate: float, capacity: float = 0):
+        self.rate = max(rate, 0.1)
+        self.capacity = capacity or max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._ts = monotonic()
+        self._paused_until = 0.0
+        self._lock = aio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now < self._paused_until:
+                    await aio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await aio.sleep((1 - self._tokens) / self.rate)
+
+_bcast_bucket = TokenBucket(BROADCAST_RATE)
+_bcast_jobs = {}    # job_id -> stato live dei job in esecuzione
+_bcast_tasks = set()   # task dei job avviati (anche prima che entrino in _bcast_jobs)
+_bcast_paused = False  # True durante /restore_db: nessun job parte o riparte
+BROADCAST_POLL_S = 2   # il leader cerca job nuovi (creati anche da un'istanza in standby)
+# esiti tenuti oltre il cursore salvato: dopo un riavvio si ripetono al più questi invii
+BROADCAST_AHEAD = 4 * max(BROADCAST_CONCURRENCY, 1)
+_bg_tasks = set()   # riferimenti ai task in background (evita il GC)
+
+def _spawn(coro):
+    t = aio.get_running_loop().create_task(coro)
+    _bg_tasks.add(t)
+    t.add_done_callback(_bg_tasks.discard)
+    return t
+
+def _seconds(v) -> float:
+    return v.total_seconds() if isinstance(v, timedelta) else float(v)
+
+def _q_create_job(conn, text: str, admin_chat_id: int) -> int:
+    total = conn.execute("SELECT COUNT(*) FROM users WHERE active=1").fetchone()[0]
+    cur = conn.execute("INSERT INTO broadcast_jobs(text, status, created_utc, total, admin_chat_id) "
+                       "VALUES (?, 'running', ?, ?, ?)",
+                       (text, datetime.now(timezone.utc).isoformat(timespec="seconds"), total, admin_chat_id))
+    conn.commit()
+    return cur.lastrowid
+
+def _q_get_job(conn, job_id: int):
+    conn.row_factory = sqlite3.Row
+    try:
+        r = conn.execute("SELECT * FROM broadcast_jobs WHERE job_id=?", (job_id,)).fetchone()
+    finally:
+        conn.row_factory = None
+    return dict(r) if r else None
+
+def _q_last_job_id(conn):
+    r = conn.execute("SELECT MAX(job_id) FROM broadcast_jobs").fetchone()
+    return r[0]
+
+def _q_running_jobs(conn):
+    return [r[0] for r in conn.execute("SELECT job_id FROM broadcast_jobs WHERE status='running' ORDER BY job_id")]
+
+def _q_bcast_batch(conn, after_uid: int, limit: int):
+    return [r[0] for r in conn.execute(
+        "SELECT user_id FROM users WHERE user_id > ? AND active=1 ORDER BY user_id LIMIT ?", (after_uid, limit))]
+
+def _q_job_set(conn, job_id: int, **fields):
+    cols = ", ".join(f"{k}=?" for k in fields)
+    conn.execute(f"UPDATE broadcast_jobs SET {cols} WHERE job_id=?", (*fields.values(), job_id))
+    conn.commit()
+
+def _q_job_checkpoint(conn, job_id: int, cursor: int, sent: int, failed: int, blocked: int, inactive_ids):
+    if inactive_ids:
+        conn.executemany("UPDATE users SET active=0 WHERE user_id=?", [(u,) for u in inactive_ids])
+    conn.execute("UPDATE broadcast_jobs SET cursor=?, sent=?, failed=?, blocked=? WHERE job_id=?",
+                 (cursor, sent, failed, blocked, job_id))
+    conn.commit()
+
+def _bcast_status_text(st: dict) -> str:
+    done = st["sent"] + st["failed"] + st["blocked"]
+    total = max(st["total"], done)
+    pct = (100 * done / total) if total else 100.0
+    head = f"📣 Broadcast #{st['job_id']} — {st['status']}"
+    lines = [head, f"Progresso: {done}/{total} ({pct:.1f}%)",
+             f"✅ {st['sent']} | ❌ {st['failed']} | 🚫 {st['blocked']}"]
+    if st["status"] == "running":
+        elapsed = monotonic() - st["started"]
+        rate = st["done_run"] / elapsed if elapsed > 0 else 0
+        if rate > 0:
+            eta = int((total - done) / rate)
+            lines.append(f"⚡ {rate:.1f} msg/s — ETA {eta // 60}m{eta % 60:02d}s")
+        else:
+            lines.append("⚡ in avvio…")
+    return "\n".join(lines)
+
+async def _bcast_edit_status(bot, st: dict):
+    if not st.get("status_msg_id"):
+        return
+    try:
+        await bot.edit_message_text(chat_id=st["admin_chat_id"], message_id=st["status_msg_id"],
+                                    text=_bcast_status_text(st))
+    except tgerr.BadRequest as e:
+        if "not modified" not in str(e).lower():
+            logger.warning(f"broadcast status edit: {e}")
+    except tgerr.TelegramError as e:
+        logger.warning(f"broadcast status edit: {e}")
+
+def _bcast_finish(st: dict, uid: int, outcome: str):
+    """Esito di un invio; il cursore avanza solo fin dove il blocco è finito senza buchi."""
+    st[outcome] += 1
+    st["done_run"] += 1
+    st["finished"][uid] = outcome
+    ids, pos = st["batch"], st["pos"]
+    while pos < len(ids) and ids[pos] in st["finished"]:
+        st["saved"][st["finished"].pop(ids[pos])] += 1
+        st["cursor"] = ids[pos]
+        pos += 1
+    if pos != st["pos"]:
+        st["pos"] = pos
+        st["advanced"].set()   # sveglia i worker fermi sulla finestra
+        st["advanced"] = aio.Event()
+
+async def _bcast_checkpoint(st: dict):
+    """Salva cursore e contatori fino al cursore: dopo un riavvio si riparte dal primo
+    utente senza esito; si ripetono al più gli esiti oltre il cursore (< BROADCAST_AHEAD).
+    Gli utenti inattivi oltre il cursore aspettano il checkpoint successivo: disattivati
+    ora sparirebbero dal batch ripreso senza essere contati."""
+    cursor = st["cursor"]
+    inactive = [u for u in st["inactive"] if u <= cursor]
+    st["inactive"] = [u for u in st["inactive"] if u > cursor]
+    saved = st["saved"]
+    await db_call(_q_job_checkpoint, st["job_id"], cursor,
+                  saved["sent"], saved["failed"], saved["blocked"], inactive)
+    for uid in inactive:
+        USER_INDEX.discard(uid)   # al prossimo /start passa dal DB e torna attivo
+
+async def _bcast_send_one(bot, st: dict, queue: aio.PriorityQueue):
+    # coda per user_id: un retry (id basso) passa davanti ai nuovi e libera subito il cursore
+    while True:
+        uid, attempt, not_before = await queue.get()
+        try:
+            while bisect_left(st["batch"], uid) - st["pos"] >= BROADCAST_AHEAD:
+                await st["advanced"].wait()
+            wait = not_before - monotonic()
+            if wait > 0:
+                await aio.sleep(wait)
+            await _bcast_bucket.acquire()
+            try:
+                await bot.send_message(chat_id=uid, text=st["text"], protect_content=True)
+                outcome = "sent"
+            except tgerr.RetryAfter as e:
+                # flood control: fermo globale e il messaggio torna in coda (non conta come tentativo)
+                delay = _seconds(e.retry_after) + 0.5
+                _bcast_bucket.pause(delay)
+                queue.put_nowait((uid, attempt, monotonic() + delay))
+                continue
+            except tgerr.Forbidden:
+                outcome = "blocked"
+                st["inactive"].append(uid)
+            except tgerr.BadRequest as e:
+                outcome = "failed"
+                if "chat not found" in str(e).lower():
+                    st["inactive"].append(uid)
+            except (tgerr.TimedOut, tgerr.NetworkError) as e:
+                if attempt + 1 < BROADCAST_MAX_RETRIES:
+                    queue.put_nowait((uid, attempt + 1, monotonic() + 2 ** attempt))
+                    continue
+                outcome = "failed"
+                logger.warning(f"broadcast {uid}: {e}")
+            except Exception as e:
+                outcome = "failed"
+                logger.warning(f"broadcast {uid}: {e}")
+            _bcast_finish(st, uid, outcome)
+        finally:
+            queue.task_done()
+
+async def _bcast_reporter(bot, st: dict):
+    while True:
+        await aio.sleep(BROADCAST_EDIT_EVERY)
+        try:
+            await _bcast_checkpoint(st)
+        except Exception as e:
+            logger.warning(f"broadcast #{st['job_id']} checkpoint: {e}")
+        await _bcast_edit_status(bot, st)
+
+async def run_broadcast_job(bot, job_id: int):
+    job = await db_call(_q_get_job, job_id)
+    # solo il leader invia: due istanze non lavorano mai sullo stesso job
+    if not job or job["status"] != "running" or job_id in _bcast_jobs or not LEASE.is_leader or _bcast_paused:
+        return
+    st = dict(job, started=monotonic(), done_run=0, inactive=[], batch=[], pos=0, finished={},
+              advanced=aio.Event(), saved={k: job[k] for k in ("sent", "failed", "blocked")})
+    _bcast_jobs[job_id] = st
+    reporter = _spawn(_bcast_reporter(bot, st))
+    try:
+        while True:
+            ids = await db_call(_q_bcast_batch, st["cursor"], BROADCAST_BATCH)
+            if not ids:
+                break
+            st.update(batch=ids, pos=0, finished={})
+            queue = aio.PriorityQueue()
+            for uid in ids:
+                queue.put_nowait((uid, 0, 0.0))
+            workers = [_spawn(_bcast_send_one(bot, st, queue))
+                       for _ in range(min(BROADCAST_CONCURRENCY, len(ids)))]
+            try:
+                await queue.join()
+            finally:
+                for w in workers: w.cancel()
+                # anche se interrotti (lease persa, stop): si salva quanto finito finora
+                await _bcast_checkpoint(st)
+        st["status"] = "done"
+        await db_call(_q_job_set, job_id, status="done",
+                      finished_utc=datetime.now(timezone.utc).isoformat(timespec="seconds"))
+        logger.info(f"Broadcast #{job_id} finito: ✅{st['sent']} ❌{st['failed']} 🚫{st['blocked']}")
+    finally:
+        reporter.cancel()
+        _bcast_jobs.pop(job_id, None)
+    await _bcast_edit_status(bot, st)
+    if st.get("admin_chat_id"):
+        try:
+            await bot.send_message(chat_id=st["admin_chat_id"], protect_content=True,
+                                   text=f"Broadcast #{job_id} finito: ✅{st['sent']} | ❌{st['failed']} | 🚫{st['blocked']}")
+        except tgerr.TelegramError as e:
+            logger.warning(f"broadcast notify: {e}")
+
+async def resume_broadcasts(app: Application):
+    for job_id in await db_call(_q_running_jobs):
+        if job_id not in _bcast_jobs:
+            logger.info(f"Avvio/ripresa broadcast #{job_id}")
+            start_broadcast(app.bot, job_id)
+
+def start_broadcast(bot, job_id: int):
+    t = _spawn(run_broadcast_job(bulk_bot(bot), job_id))
+    _bcast_tasks.add(t)
+    t.add_done_callback(_bcast_tasks.discard)
+
+async def broadcast_watcher(app: Application):
+    """Solo sul leader: riprende i job 'running' e avvia quelli creati dalle altre istanze."""
+    while True:
+        try:
+            await resume_broadcasts(app)
+        except Exception as e:
+            logger.warning(f"broadcast_watcher: {e}")
+        await aio.sleep(BROADCAST_POLL_S)
+
+async def stop_broadcasts():
+    """Alla perdita della lease: i job ripartono dall'ultimo checkpoint sul nuovo leader."""
+    tasks = list(_bcast_tasks)
+    for t in tasks:
+        t.cancel()
+    await aio.gather(*tasks, return_exceptions=True)
 
 async def cmd_broadcast(update, context):
     if not admin_only_private(update): return
@@ -353,74 +2195,199 @@ async def cmd_broadcast(update, context):
         await update.message.reply_text("Uso: /broadcast <messaggio>", protect_content=True)
         return
     text = " ".join(context.args)
-    conn = sqlite3.connect(DB_FILE)
-    ids = [r[0] for r in conn.execute("SELECT user_id FROM users").fetchall()]
-    conn.close()
-    ok=ko=0
-    await update.message.reply_text(f"Invio a {len(ids)} utenti…", protect_content=True)
-    for uid in ids:
-        try:
-            await context.bot.send_message(chat_id=uid, text=text, protect_content=True)
-            ok+=1
-            await aio.sleep(0.03)
-        except:
-            ko+=1
-            await aio.sleep(0.03)
-    await update.message.reply_text(f"Broadcast finito: ✅{ok} | ❌{ko}", protect_content=True)
+    job_id = await db_call(_q_create_job, text, update.effective_chat.id)
+    job = await db_call(_q_get_job, job_id)
+    status = await update.message.reply_text(
+        f"📣 Broadcast #{job_id} avviato: {job['total']} utenti. Stato: /broadcast_status",
+        protect_content=True)
+    await db_call(_q_job_set, job_id, status_msg_id=status.message_id)
+    if LEASE.is_leader:
+        start_broadcast(context.bot, job_id)
+    # in standby (webhook) il job resta nel DB: lo avvia il leader entro BROADCAST_POLL_S
+
+async def cmd_broadcast_status(update, context):
+    if not admin_only_private(update): return
+    if _bcast_jobs:
+        text = "\n\n".join(_bcast_status_text(st) for st in _bcast_jobs.values())
+    else:
+        job_id = await db_call(_q_last_job_id)
+        job = await db_call(_q_get_job, job_id) if job_id else None
+        if not job:
+            await update.message.reply_text("Nessun broadcast.", protect_content=True)
+            return
+        text = _bcast_status_text(dict(job, started=monotonic(), done_run=0))
+    await update.message.reply_text(text, protect_content=True)
 
 # ---------- /restore_db (admin solo privato) ----------
+# Il file caricato viene verificato e preparato in un worker thread accanto al DB vivo
+# (DB_FILE.restore); il thread del DB lo mette al posto di DB_FILE con os.replace, quindi
+# un crash a metà lascia o il DB vecchio o quello nuovo, mai un file a metà.
+# Con più istanze (standby, webhook) le altre vanno fermate prima: solo il leader accetta
+# il comando e lo swap si annulla se il DB risulta ancora aperto da un altro processo.
+RESTORE_EXTS = (".db", ".db.gz", ".db.zst")
+RESTORE_REQUIRED_COLS = {"user_id", "username", "first_name", "last_name", "joined_utc"}
+RESTORE_DRAIN_S = 60   # attesa massima per export/backup in corso prima dello swap
+
+def inspect_db_file(path: Path) -> dict:
+    """Controlli sul file candidato (worker thread): header, integrity_check, schema, conteggi."""
+    with open(path, "rb") as fh:
+        if fh.read(16) != b"SQLite format 3\x00":
+            raise ValueError("non è un database SQLite")
+    conn = sqlite3.connect(f"file:{path.resolve()}?immutable=1", uri=True)
+    try:
+        problems = [r[0] for r in conn.execute("PRAGMA integrity_check(5)")]
+        if problems != ["ok"]:
+            raise ValueError("integrity_check: " + "; ".join(problems))
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(users)")}
+        if not cols:
+            raise ValueError("tabella users assente")
+        missing = RESTORE_REQUIRED_COLS - cols
+        if missing:
+            raise ValueError(f"colonne mancanti in users: {', '.join(sorted(missing))}")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > len(MIGRATIONS):
+            raise ValueError(f"schema v{version} più recente di questo bot (v{len(MIGRATIONS)})")
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        active = conn.execute("SELECT COUNT(*) FROM users WHERE active=1").fetchone()[0] if "active" in cols else users
+        return {"users": users, "active": active, "version": version}
+    finally:
+        conn.close()
+
+def prepare_restore(upload: Path, name: str):
+    """Decomprime se serve, valida e costruisce DB_FILE.restore già migrato -> (staging, info)."""
+    with open(upload, "rb") as fh:
+        reader = _decompressor(fh, name)
+        if reader is not None:
+            raw = upload.with_name(upload.name + ".db")
+            with reader, open(raw, "wb") as out:
+                shutil.copyfileobj(reader, out, 1024 * 1024)
+            upload.unlink()
+            upload = raw
+    info = inspect_db_file(upload)
+    staging = Path(DB_FILE + ".restore")
+    staging.unlink(missing_ok=True)
+    src = sqlite3.connect(f"file:{upload.resolve()}?immutable=1", uri=True)
+    dst = sqlite3.connect(staging)
+    try:
+        src.backup(dst)
+        _init_schema(dst)   # colonne/tabelle mancanti + migrazioni, fuori dal thread del DB
+        # un backup preso a metà broadcast non deve farlo ripartire (rimanderebbe messaggi vecchi)
+        info["interrupted"] = [r[0] for r in dst.execute(
+            "SELECT job_id FROM broadcast_jobs WHERE status='running' ORDER BY job_id")]
+        dst.execute("UPDATE broadcast_jobs SET status='interrupted' WHERE status='running'")
+        dst.commit()
+        dst.execute("PRAGMA journal_mode=DELETE")   # un solo file, nessun -wal da spostare
+    finally:
+        dst.close(); src.close()
+        upload.unlink(missing_ok=True)
+    with open(staging, "rb+") as fh:
+        os.fsync(fh.fileno())
+    return staging, info
+
+def safety_copy(dest: Path):
+    """Copia consistente del DB attuale con una connessione propria (worker thread)."""
+    with DB_FILE_GATE.reading():
+        src, dst = sqlite3.connect(DB_FILE, timeout=10), sqlite3.connect(dest)
+        try:
+            src.backup(dst)   # include anche quanto ancora nel file -wal
+        finally:
+            dst.close(); src.close()
+
+def _diff(old: int, new: int) -> str:
+    return f"{old} → {new} ({new - old:+d})"
+
 async def cmd_restore_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _bcast_paused
     if not admin_only_private(update): return
 
     msg = update.effective_message
     if not msg or not msg.reply_to_message or not msg.reply_to_message.document:
         await update.message.reply_text(
             "📦 Per ripristinare:\n"
-            "1) Invia un file **.db** al bot (come documento)\n"
+            "1) Invia un file **.db** (o il .db.gz di /backup_db) al bot come documento\n"
             "2) Fai **Rispondi** a quel messaggio con `/restore_db`",
             protect_content=True
         )
         return
 
+    if not LEASE.is_leader:
+        await update.message.reply_text("❌ Questa istanza è in standby: /restore_db va eseguito sul leader.",
+                                        protect_content=True)
+        return
+
     doc = msg.reply_to_message.document
-    if not (doc.file_name and doc.file_name.endswith(".db")):
-        await update.message.reply_text("❌ Il file deve avere estensione .db", protect_content=True)
+    if not (doc.file_name and doc.file_name.endswith(RESTORE_EXTS)):
+        await update.message.reply_text("❌ Il file deve avere estensione .db, .db.gz o .db.zst", protect_content=True)
         return
 
+    Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(BACKUP_DIR) / f"restore_tmp_{doc.file_unique_id}"
+    staging = None
     try:
-        Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
-        tmp_path = Path(BACKUP_DIR) / f"restore_tmp_{doc.file_unique_id}.db"
-        file = await doc.get_file()
+        file = await bulk_bot(context.bot).get_file(doc.file_id)
         await file.download_to_drive(custom_path=str(tmp_path))
     except Exception as e:
         await update.message.reply_text(f"❌ Errore download file: {e}", protect_content=True)
         return
 
+    status = await update.message.reply_text("🔎 Verifica del file…", protect_content=True)
     try:
-        safety_copy = Path(BACKUP_DIR) / f"pre_restore_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.bak"
-        if Path(DB_FILE).exists():
-            shutil.copy2(DB_FILE, safety_copy)
-    except Exception as e:
-        await update.message.reply_text(f"❌ Errore copia di sicurezza: {e}", protect_content=True)
         try:
-            if tmp_path.exists():
-                tmp_path.unlink()
-        except Exception:
-            pass
-        return
+            staging, info = await aio.to_thread(prepare_restore, tmp_path, doc.file_name)
+        except (ValueError, sqlite3.DatabaseError, OSError, EOFError) as e:
+            await status.edit_text(f"❌ File non valido, DB attuale invariato: {e}")
+            return
 
-    try:
-        Path(DB_FILE).parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(tmp_path, DB_FILE)
-        await update.message.reply_text("✅ Database ripristinato con successo. Usa /adminstatus per verificare.", protect_content=True)
-    except Exception as e:
-        await update.message.reply_text(f"❌ Errore ripristino DB: {e}", protect_content=True)
-    finally:
+        # i broadcast in corso si fermano prima della copia di sicurezza (che ne ha l'ultimo
+        # checkpoint) e non ripartono finché il DB non è sostituito
+        _bcast_paused = True
+        stopped = sorted(_bcast_jobs)
+        await stop_broadcasts()
+
+        safety = Path(BACKUP_DIR) / f"pre_restore_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.bak"
         try:
-            if tmp_path.exists():
-                tmp_path.unlink()
-        except Exception:
-            pass
+            await WRITE_BEHIND.flush()   # le registrazioni in coda finiscono nella copia di sicurezza
+            if Path(DB_FILE).exists():
+                await aio.to_thread(safety_copy, safety)
+        except Exception as e:
+            await status.edit_text(f"❌ Errore copia di sicurezza: {e}")
+            return
+
+        await status.edit_text("🔁 Sostituzione del database…")
+        if not await aio.to_thread(DB_FILE_GATE.begin_swap, RESTORE_DRAIN_S):
+            await status.edit_text("❌ Export/backup in corso da troppo tempo: riprova più tardi.")
+            return
+        t0 = perf_counter()
+        try:
+            old = await db_call(_q_swap_db, staging)
+        except Exception as e:
+            await status.edit_text(f"❌ Errore ripristino DB: {e}")
+            return
+        finally:
+            DB_FILE_GATE.end_swap()
+        swap_ms = (perf_counter() - t0) * 1000
+        await reload_db_caches()
+        logger.info(f"/restore_db: {old['users']} -> {info['users']} utenti, swap {swap_ms:.0f} ms")
+        lines = [
+            f"✅ Database ripristinato (swap {swap_ms:.0f} ms)",
+            f"👥 Utenti: {_diff(old['users'], info['users'])}",
+            f"🟢 Attivi: {_diff(old['active'], info['active'])}",
+            f"🧪 integrity_check: ok · schema v{info['version']} → v{len(MIGRATIONS)}",
+            f"💾 Copia di sicurezza: {safety.name}",
+        ]
+        if stopped:
+            lines.append(f"⏹ Broadcast fermati (restano nella copia di sicurezza): "
+                         f"{', '.join(f'#{j}' for j in stopped)}")
+        if info["interrupted"]:
+            lines.append(f"⏸ Broadcast in corso nel file ripristinato, segnati 'interrupted' e non ripresi: "
+                         f"{', '.join(f'#{j}' for j in info['interrupted'])}")
+        await status.edit_text("\n".join(lines))
+    finally:
+        _bcast_paused = False   # se lo swap è fallito il leader riprende i job del DB attuale
+        for p in (tmp_path, tmp_path.with_name(tmp_path.name + ".db"), staging):
+            if p:
+                try: p.unlink(missing_ok=True)
+                except OSError: pass
 
 # ---------- AUTO-BACKUP GIORNALIERO ----------
 def _parse_hhmm(s: str) -> dtime:
@@ -440,48 +2407,468 @@ async def nightly_backup_task(app: Application):
         wait_sec = (today_target - now).total_seconds()
         await aio.sleep(wait_sec)
         try:
-            p = make_backup_copy(DB_FILE, BACKUP_DIR)
-            cleanup_old_backups(BACKUP_DIR, BACKUP_RETENTION_DAYS)
-            logger.info(f"Auto-backup creato: {p}")
-            if BACKUP_NOTIFY_ADMIN == "1" and ADMIN_ID:
+            entry, is_new = await aio.to_thread(run_backup, BACKUP_DIR)
+            await aio.to_thread(cleanup_old_backups, BACKUP_DIR, BACKUP_RETENTION_DAYS)
+            if not is_new:
+                logger.info(f"Auto-backup saltato: DB identico a {entry['name']}")
+            else:
+                logger.info(f"Auto-backup creato: {entry['name']}")
+            if is_new and BACKUP_NOTIFY_ADMIN == "1" and ADMIN_ID:
                 try:
-                    await app.bot.send_message(chat_id=ADMIN_ID, text=f"✅ Auto-backup creato: {p.name}", protect_content=True)
+                    await app.bot.send_message(chat_id=ADMIN_ID, text=f"✅ Auto-backup creato: {entry['name']}", protect_content=True)
                 except Exception as e:
                     logger.warning(f"Notify admin failed: {e}")
         except Exception as e:
             logger.error(f"Auto-backup errore: {e}")
         await aio.sleep(60)
 
-# ---------- ANTI-CONFLICT ----------
-async def ensure_no_webhook(app: Application):
+# ---------- LEADER (lease su SQLite) ----------
+# Niente più Conflict + retry ogni 10s: le istanze si contendono una riga di LEADER_DB.
+# Il leader la rinnova ogni LEASE_HEARTBEAT s con scadenza a LEASE_TTL s; una standby la
+# prende appena scade o viene rilasciata (SIGTERM), quindi entro ~1s dalla fine del leader.
+# Solo il leader fa polling (in webhook gli update arrivano a tutte) e job pianificati.
+class LeaderLease:
+    NAME = "bot"
+
+    def __init__(self, path: str, ttl: float, beat: float):
+        self.path, self.ttl, self.beat = path, ttl, beat
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+        self.is_leader = False
+        self._valid_until = 0.0   # scadenza (monotonic) dell'ultimo rinnovo riuscito
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lease")
+        self._conn = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.beat, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS leases(
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_ts REAL NOT NULL
+            )""")
+            self._conn = conn
+        return self._conn
+
+    def _q_claim(self) -> bool:
+        """Prende o rinnova la lease in un solo statement (atomico tra processi)."""
+        now = _now_ts()
+        cur = self._db().execute(
+            "INSERT INTO leases(name, holder, expires_ts) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_ts=excluded.expires_ts "
+            "WHERE leases.holder=excluded.holder OR leases.expires_ts < ?",
+            (self.NAME, self.holder, now + self.ttl, now))
+        return cur.rowcount == 1
+
+    def _q_release(self):
+        self._db().execute("UPDATE leases SET expires_ts=0 WHERE name=? AND holder=?", (self.NAME, self.holder))
+
+    def _q_close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def _call(self, fn):
+        return await aio.get_running_loop().run_in_executor(self._executor, fn)
+
+    async def _claim(self):
+        """True/False; None se SQLite non risponde (es. file bloccato)."""
+        t0 = monotonic()
+        try:
+            ok = await self._call(self._q_claim)
+        except sqlite3.Error as e:
+            logger.warning(f"lease: {e}")
+            return None
+        if ok:
+            self._valid_until = t0 + self.ttl
+        return ok
+
+    async def acquire(self, stop: aio.Event) -> bool:
+        """Standby finché la lease non è libera; False se arriva prima lo stop."""
+        waiting = False
+        while not stop.is_set():
+            if await self._claim():
+                self.is_leader = True
+                return True
+            if not waiting:
+                logger.info("Standby: un'altra istanza è leader, attendo la lease…")
+                waiting = True
+            await _wait_event(stop, self.beat)
+        return False
+
+    async def hold(self, stop: aio.Event):
+        """Rinnova la lease; ritorna allo stop o appena la lease è persa."""
+        while not stop.is_set():
+            await _wait_event(stop, self.beat)
+            if stop.is_set():
+                return
+            ok = await self._claim()
+            # presa da un'altra istanza, oppure rinnovi falliti fin quasi alla scadenza: ci si ferma
+            if ok is False or (ok is None and monotonic() >= self._valid_until - self.beat):
+                self.is_leader = False
+                logger.warning("Lease persa: torno in standby")
+                return
+
+    async def release(self):
+        if self.is_leader:
+            self.is_leader = False
+            try:
+                await self._call(self._q_release)
+                logger.info("Lease rilasciata")
+            except sqlite3.Error as e:
+                logger.warning(f"lease release: {e}")
+
+    async def close(self):
+        await self._call(self._q_close)
+
+LEASE = LeaderLease(LEADER_DB, LEASE_TTL, LEASE_HEARTBEAT)
+
+async def _wait_event(event: aio.Event, timeout: float):
     try:
-        await app.bot.delete_webhook(drop_pending_updates=True)
-        logger.info("Webhook eliminato (anti-conflict).")
-    except Exception as e:
-        logger.warning(f"delete_webhook: {e}")
+        await aio.wait_for(event.wait(), timeout)
+    except aio.TimeoutError:
+        pass
 
-def run_polling_with_guard(app: Application):
-    loop = aio.get_event_loop()
-    loop.create_task(nightly_backup_task(app))
-    loop.run_until_complete(ensure_no_webhook(app))
-    while True:
+def _stop_event() -> aio.Event:
+    stop = aio.Event()
+    loop = aio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError: pass
+    return stop
+
+async def lead(app: Application, stop: aio.Event, polling: bool):
+    """standby -> leader -> (lease persa) standby…, finché non arriva lo stop."""
+    while await _timed("lease", LEASE.acquire(stop)):
+        logger.info(f"Leader: {LEASE.holder}")
+        if polling:   # start_polling elimina anche un eventuale webhook; gli update in coda restano
+            await _timed("start_polling", app.updater.start_polling())
+            if STARTUP_TIMING:
+                logger.info(startup_report())
+        jobs = [_spawn(nightly_backup_task(app)), _spawn(broadcast_watcher(app))]
         try:
-            app.run_polling(close_loop=False, drop_pending_updates=True)
+            await LEASE.hold(stop)
+        finally:
+            # prima si smette di leggere update, poi si libera la lease: mai due polling insieme
+            if polling and app.updater.running:
+                await app.updater.stop()
+            for t in jobs:
+                t.cancel()
+            await stop_broadcasts()
+            await LEASE.release()
+
+async def run_polling(app: Application):
+    stop = _stop_event()
+    await startup(app)
+    try:
+        await app.start()
+        await lead(app, stop, polling=True)
+    finally:
+        if app.running:
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+# ---------- SERVER HTTP (webhook + health) ----------
+# Server HTTP/1.1 minimale su asyncio (keep-alive, Content-Length): niente dipendenze extra.
+# Le rotte sono (metodo, path) -> async fn(headers, body) -> (status, content_type, bytes).
+HTTP_ROUTES = {}      # server principale (webhook su PORT)
+METRICS_ROUTES = {}   # server su METRICS_PORT (healthz + metrics)
+
+def _json_response(status: int, data: dict):
+    return status, "application/json", json.dumps(data).encode()
+
+async def _read_request(reader):
+    """(header, body) della richiesta; body None se supera HTTP_MAX_BODY (non viene letto)."""
+    headers = {}
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n", b"\n", b""):
             break
-        except tgerr.Conflict:
-            logger.warning("Conflict: altro polling attivo — ritento tra 10s…")
-            sleep(10)
+        k, _, v = h.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > HTTP_MAX_BODY:
+        return headers, None
+    return headers, (await reader.readexactly(length) if length else b"")
+
+HEALTH_PATHS = {"/healthz"}
+_http_writers = set()   # connessioni aperte, chiuse allo stop del server
+
+async def _http_serve(reader, writer, routes: dict, overflow: bool = False):
+    """Richieste sulla connessione finché keep-alive. overflow = posti finiti: una sola
+    richiesta, solo /healthz viene servita (le altre 503) e poi si chiude."""
+    while True:
+        line = await aio.wait_for(reader.readline(), timeout=HTTP_IDLE_TIMEOUT)
+        if not line:
+            return
+        method, target, version = line.decode("latin-1").split()
+        headers, body = await aio.wait_for(_read_request(reader), timeout=HTTP_REQUEST_TIMEOUT)
+        path = target.split("?", 1)[0]
+        if body is None:
+            status, ctype, payload = _json_response(413, {"ok": False})
+            keep = False
+        elif overflow and path not in HEALTH_PATHS:
+            status, ctype, payload = _json_response(503, {"ok": False})
+            keep = False
+        else:
+            route = routes.get((method, path))
+            if route:
+                status, ctype, payload = await route(headers, body)
+            else:
+                status, ctype, payload = _json_response(404, {"ok": False})
+            keep = not overflow and version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: {ctype}\r\nContent-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep else 'close'}\r\n\r\n".encode("latin-1") + payload)
+        await aio.wait_for(writer.drain(), timeout=HTTP_REQUEST_TIMEOUT)
+        if not keep:
+            return
+
+async def _http_connection(reader, writer, sem: aio.Semaphore, routes: dict):
+    # ogni connessione tiene un posto del semaforo: un client lento o muto lo perde in fretta
+    # (HTTP_IDLE_TIMEOUT in attesa della richiesta, HTTP_REQUEST_TIMEOUT per header + body).
+    # A posti finiti non si aspetta: /healthz risponde comunque, il resto riceve 503.
+    _http_writers.add(writer)
+    try:
+        if sem.locked():
+            await _http_serve(reader, writer, routes, overflow=True)
+        else:
+            async with sem:
+                await _http_serve(reader, writer, routes)
+    except (aio.TimeoutError, aio.IncompleteReadError, ConnectionError, ValueError, aio.CancelledError):
+        pass   # CancelledError: server in chiusura, la connessione si chiude senza traceback
+    except Exception as e:
+        logger.warning(f"http: {e}")
+    finally:
+        _http_writers.discard(writer)
+        writer.close()
+
+def add_webhook_routes(app: Application):
+    async def webhook(headers, body):
+        if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET):
+            return _json_response(403, {"ok": False})
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
         except Exception as e:
-            logger.error(f"Errore polling: {e} — ritento tra 10s…")
-            sleep(10)
+            logger.warning(f"webhook: update non valido: {e}")
+            return _json_response(400, {"ok": False})
+        await app.update_queue.put(update)
+        return _json_response(200, {"ok": True})
+
+    HTTP_ROUTES[("POST", WEBHOOK_PATH)] = webhook
+
+def add_health_routes(app: Application, routes: dict, metrics: bool = True):
+    async def health(headers, body):
+        return _json_response(200 if app.running else 503, {
+            "ok": app.running, "mode": MODE, "leader": LEASE.is_leader,
+            "update_queue": app.update_queue.qsize()})
+
+    async def prometheus(headers, body):
+        if METRICS_TOKEN and not hmac.compare_digest(headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+            return _json_response(401, {"ok": False})
+        return 200, "text/plain; version=0.0.4", METRICS.render_prometheus().encode()
+
+    routes[("GET", "/healthz")] = health
+    if metrics:
+        routes[("GET", "/metrics")] = prometheus
+
+async def start_http_server(host: str = HTTP_LISTEN, port: int = HTTP_PORT, routes: dict = HTTP_ROUTES):
+    # margine sopra le connessioni concesse a Telegram (setWebhook): health check e metriche
+    # trovano posto anche quando il webhook le usa tutte
+    sem = aio.Semaphore(WEBHOOK_MAX_CONNECTIONS + HTTP_SPARE_CONNECTIONS)
+    server = await aio.start_server(lambda r, w: _http_connection(r, w, sem, routes), host, port)
+    logger.info(f"Server HTTP in ascolto su {host}:{port} — rotte: {sorted(p for _, p in routes)}")
+    return server
+
+async def stop_http_server(server):
+    server.close()
+    for w in list(_http_writers):   # keep-alive inattive: senza questo restano aperte fino al timeout
+        w.close()
+    await server.wait_closed()
+
+async def run_webhook(app: Application):
+    stop = _stop_event()
+    await startup(app)
+    add_webhook_routes(app)
+    # porta pubblica: /metrics solo con token (o se l'operatore la sceglie come METRICS_PORT)
+    add_health_routes(app, HTTP_ROUTES, metrics=bool(METRICS_TOKEN) or METRICS_PORT == HTTP_PORT)
+    server = await _timed("http_server", start_http_server())
+    try:
+        await app.start()
+        if WEBHOOK_URL:
+            await _timed("set_webhook", app.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES))
+            logger.info(f"Webhook impostato: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            logger.warning("WEBHOOK_URL non impostato: set_webhook saltato (solo test locale).")
+        if STARTUP_TIMING:
+            logger.info(startup_report())
+        await lead(app, stop, polling=False)   # tutte servono il webhook, solo il leader fa i job
+    finally:
+        await stop_http_server(server)
+        if app.running:
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+_http_server = None   # server su METRICS_PORT
+
+async def on_startup(app: Application):
+    global _http_server
+    if not METRICS.gauges:
+        _spawn(loop_lag_monitor())
+        METRICS.gauges["update_queue"] = app.update_queue.qsize
+        METRICS.gauges["known_users"] = USER_INDEX.__len__
+        METRICS.gauges["write_behind_depth"] = WRITE_BEHIND.__len__
+        METRICS.gauges["ui_state_cached"] = UI_STATE.__len__
+        METRICS.gauges["is_leader"] = lambda: int(LEASE.is_leader)
+        proc = app.update_processor
+        if isinstance(proc, LaneUpdateProcessor):
+            for lane in proc.limits:
+                METRICS.gauges[f"lane_{lane}_busy"] = lambda lane=lane: proc.busy[lane]
+            METRICS.gauges["updates_waiting"] = proc.waiting
+        for lane, req in InstrumentedRequest.lanes.items():
+            METRICS.gauges[f"http_{lane}_in_flight"] = lambda req=req: req.in_flight
+            METRICS.gauges[f"http_{lane}_pool_size"] = lambda req=req: req.pool_size
+        _spawn(ui_state_sweeper())
+        _spawn(STATS.run())
+    WRITE_BEHIND.start()
+    if METRICS_PORT and _http_server is None and not (MODE == "webhook" and METRICS_PORT == HTTP_PORT):
+        add_health_routes(app, METRICS_ROUTES)
+        _http_server = await start_http_server(HTTP_LISTEN, METRICS_PORT, METRICS_ROUTES)
+
+async def on_stop(app: Application):
+    await MODERATION.close(app.bot)   # il client HTTP del bot è ancora aperto
+
+async def on_shutdown(app: Application):
+    global _http_server
+    if _http_server is not None:
+        await stop_http_server(_http_server)
+        _http_server = None
+    await STATS.flush()
+    await WRITE_BEHIND.close()
+    await db_close()
+    await LEASE.close()
+    if BULK_BOT:
+        await BULK_BOT.shutdown()
+
+# ---------- ELABORAZIONE CONCORRENTE (corsie + ordine per chat) ----------
+# PTB crea un task per update; qui ogni task attende prima il turno della propria chat
+# (ordine garantito dentro la chat) e poi un posto nella sua corsia: "user" per tutto il
+# resto, "admin" per i comandi admin pesanti, che così non occupano i posti degli utenti.
+# Il semaforo di PTB resta largo (MAX_PENDING_UPDATES) e fa solo da limite di sicurezza:
+# chi aspetta la propria chat non toglie posti alle altre.
+MAX_PENDING_UPDATES = 4096
+HEAVY_ADMIN_COMMANDS = {"backup_db", "export", "export_json", "export_xlsx", "restore_db",
+                        "broadcast", "stats", "list", "find"}
+
+class LaneUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, user_limit: int, admin_limit: int):
+        super().__init__(max_concurrent_updates=MAX_PENDING_UPDATES)
+        self.limits = {"user": max(1, user_limit), "admin": max(1, admin_limit)}
+        self._lanes = {lane: aio.Semaphore(n) for lane, n in self.limits.items()}
+        self.busy = {lane: 0 for lane in self.limits}
+        self.pending = 0   # update entrati e non ancora finiti (in attesa + in corso)
+        self._chats = {}   # chat_id -> [Lock, update in attesa o in corso]
+
+    @staticmethod
+    def lane_of(update) -> str:
+        if not isinstance(update, Update) or not update.effective_user or not is_admin(update.effective_user.id):
+            return "user"
+        text = (update.message and update.message.text) or ""
+        if text.startswith("/") and text[1:].split(maxsplit=1)[0].split("@")[0] in HEAVY_ADMIN_COMMANDS:
+            return "admin"
+        return "user"
+
+    async def do_process_update(self, update, coroutine):
+        lane = self.lane_of(update)
+        chat = update.effective_chat if isinstance(update, Update) else None
+        key = chat.id if chat else None
+        t0 = perf_counter()
+        self.pending += 1
+        try:
+            if key is None:
+                async with self._lanes[lane]:
+                    await self._run(lane, t0, coroutine)
+                return
+            entry = self._chats.get(key)
+            if entry is None:
+                entry = self._chats[key] = [aio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0], self._lanes[lane]:
+                    await self._run(lane, t0, coroutine)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._chats[key]
+        finally:
+            self.pending -= 1
+
+    async def _run(self, lane: str, t0: float, coroutine):
+        METRICS.observe("lane_wait", lane, perf_counter() - t0)
+        self.busy[lane] += 1
+        try:
+            await coroutine
+        finally:
+            self.busy[lane] -= 1
+
+    def waiting(self) -> int:
+        return self.pending - sum(self.busy.values())
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 # ---------- MAIN ----------
 def main():
+    _mark("import", _BOOT_T0)
     if not BOT_TOKEN: raise RuntimeError("BOT_TOKEN non impostato.")
-    init_db()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    Path(DB_FILE).parent.mkdir(parents=True, exist_ok=True)
+    Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
+    t0 = perf_counter()
+    app = build_app()
+    _mark("build_app", t0)
+    logger.info(f"SPACE420OFFICIAL avviato ({MODE}) — leader lease + auto-backup + protect_content + restore_db.")
+    aio.run(run_webhook(app) if MODE == "webhook" else run_polling(app))
+
+def build_app(tg_bot=None) -> Application:
+    """Application configurata; tg_bot permette di iniettare un Bot finto (bench.py)."""
+    global BULK_BOT
+    builder = ApplicationBuilder().post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown)
+    if tg_bot is None:
+        version = http_version()
+        timeouts = dict(connect_timeout=HTTP_CONNECT_TIMEOUT, write_timeout=HTTP_WRITE_TIMEOUT, http_version=version)
+        BULK_BOT = Bot(BOT_TOKEN, request=InstrumentedRequest(
+            "bulk", HTTP_BULK_POOL_SIZE, HTTP_BULK_POOL_TIMEOUT, read_timeout=HTTP_BULK_TIMEOUT,
+            media_write_timeout=HTTP_BULK_TIMEOUT, **timeouts))
+        builder = (builder.token(BOT_TOKEN)
+                   .request(InstrumentedRequest("interactive", HTTP_POOL_SIZE, read_timeout=HTTP_READ_TIMEOUT,
+                                                **timeouts))
+                   .get_updates_request(InstrumentedRequest("updates", 1, read_timeout=HTTP_READ_TIMEOUT,
+                                                            **timeouts)))
+    else:
+        builder = builder.bot(tg_bot)
+    app = builder.concurrent_updates(LaneUpdateProcessor(UPDATE_CONCURRENCY, ADMIN_LANE_CONCURRENCY)).build()
+    register_handlers(app)
+    return app
+
+def register_handlers(app: Application):
     # public
     app.add_handler(CommandHandler("start", cmd_start))
+    app.add_handler(CallbackQueryHandler(on_list_buttons, pattern=r"^ls:"))
     app.add_handler(CallbackQueryHandler(on_buttons))
     app.add_handler(CommandHandler("utenti", cmd_utenti))
     app.add_handler(CommandHandler("status", cmd_status))
@@ -493,8 +2880,13 @@ def main():
     app.add_handler(CommandHandler("export_json", cmd_export_json))
     app.add_handler(CommandHandler("export_xlsx", cmd_export_xlsx))
     app.add_handler(CommandHandler("list", cmd_list))
+    app.add_handler(CommandHandler("find", cmd_find))
     app.add_handler(CommandHandler("broadcast", cmd_broadcast))
+    app.add_handler(CommandHandler("broadcast_status", cmd_broadcast_status))
     app.add_handler(CommandHandler("restore_db", cmd_restore_db))
+    app.add_handler(CommandHandler("perf", cmd_perf))
+    app.add_handler(CommandHandler("modstats", cmd_modstats))
+    app.add_handler(CommandHandler("stats", cmd_stats))
     # blocco media non-admin (foto/video/documenti/voice/animazioni/audio/gif/video_note, sticker inclusi)
     media_filter = (
         filters.PHOTO
@@ -509,8 +2901,7 @@ def main():
     app.add_handler(MessageHandler(media_filter, block_media))
     # default (testi non comando → mostra home)
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, cmd_start))
-    logger.info("SPACE420OFFICIAL avviato — anti-conflict + auto-backup + protect_content + restore_db.")
-    run_polling_with_guard(app)
+    instrument_handlers(app)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file